@@ -194,6 +194,18 @@
 #
 #
 #   History:
+#   version 0.3.2-dev:
+#   * index channel users by host, domain and ident, so finding the users affected by
+#     a ban doesn't need to test every user in the channel.
+#   * compiled patterns are kept in a bounded cache, and follow the server's CASEMAPPING.
+#   * masks are saved in chanop_masks.db, one record for each channel and mode, and
+#     channel lists are loaded when first used. The old chanop_mode_cache.dat is
+#     imported once and renamed with an .old suffix.
+#   * mask lists are synced when joining a watched channel, several at once as
+#     allowed by the server's MODES and TARGMAX, lists of the current buffer first.
+#   * user lists are updated from NAMES and /who replies when joining instead of being
+#     rebuilt, /who requests are queued one at a time per server and use WHOX.
+#
 #   2013-05-24
 #   version 0.3.1: bug fixes
 #   * fix exceptions while fetching bans with /mode
@@ -280,7 +292,7 @@ WEECHAT_VERSION = (0x30200, '0.3.2')
 
 SCRIPT_NAME    = "chanop"
 SCRIPT_AUTHOR  = "Elián Hanisch <lambdae2@gmail.com>"
-SCRIPT_VERSION = "0.3.1"
+SCRIPT_VERSION = "0.3.2-dev"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC    = "Helper script for IRC Channel Operators"
 
@@ -311,8 +323,12 @@ import re
 import time
 import string
 import getopt
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from shelve import DbfilenameShelf as Shelf
+try:
+    import anydbm as dbm
+except ImportError:
+    import dbm
 
 chars = string.maketrans('', '')
 
@@ -461,36 +477,84 @@ def is_ip(s):
     except socket.error:
         return False
 
-_reCache = {}
-def cachedPattern(f):
-    """Use cached regexp object or compile a new one from pattern."""
-    def getRegexp(pattern, *arg):
+# chars that are the same letter in different case for each IRC casemapping, in
+# (upper, lower) pairs.
+_casemappingPairs = {
+        'ascii'          : '',
+        'strict-rfc1459' : '[{]}\\|',
+        'rfc1459'        : '[{]}\\|^~',
+        }
+# what we used before knowing about CASEMAPPING
+_defaultCasemapping = 'strict-rfc1459'
+
+class GlobTranslator(object):
+    """Translates glob patterns into regexps for an IRC casemapping."""
+    def __init__(self, pairs):
+        self.chars = dict([ (chr(i), re.escape(chr(i))) for i in range(256) ])
+        self.chars['*'] = '.*'
+        self.chars['?'] = '.'
+        upper, lower = string.ascii_uppercase, string.ascii_lowercase
+        for i in range(0, len(pairs), 2):
+            a, b = pairs[i:i + 2]
+            self.chars[a] = self.chars[b] = '[%s]' % re.escape(a + b)
+            upper += a
+            lower += b
+        self.fold = string.maketrans(upper, lower)
+
+    def compile(self, pattern):
+        if '*' not in pattern and '?' not in pattern:
+            return LiteralPattern(pattern, self.fold)
+        chars = self.chars
+        s = ''.join([ chars.get(c) or re.escape(c) for c in pattern ])
+        return re.compile('^%s$' % s, re.I)
+
+class LiteralPattern(object):
+    """Pattern without wildcards, matched by comparing folded strings instead of
+    using a regexp."""
+    def __init__(self, pattern, fold):
+        self.fold = fold
+        self.pattern = pattern.translate(fold)
+
+    def match(self, s):
+        return s.translate(self.fold) == self.pattern or None
+
+globTranslators = dict([ (k, GlobTranslator(v)) for k, v in _casemappingPairs.items() ])
+
+class PatternCache(OrderedDict):
+    """LRU cache of compiled patterns."""
+    def __init__(self, size):
+        OrderedDict.__init__(self)
+        self.size = size
+        self.hits = self.misses = 0
+
+    def compile(self, pattern, casemapping=None):
+        if casemapping:
+            casemapping = casemapping.lower()
+        if casemapping not in globTranslators:
+            casemapping = _defaultCasemapping
+        key = (pattern, casemapping)
         try:
-            regexp = _reCache[pattern]
+            regexp = self.pop(key)
+            self.hits += 1
         except KeyError:
-            s = '^'
-            for c in pattern:
-                if c == '*':
-                    s += '.*'
-                elif c == '?':
-                    s += '.'
-                elif c in '[{':
-                    s += r'[\[{]'
-                elif c in ']}':
-                    s += r'[\]}]'
-                elif c in '|\\':
-                    s += r'[|\\]'
-                else:
-                    s += re.escape(c)
-            s += '$'
-            regexp = re.compile(s, re.I)
-            _reCache[pattern] = regexp
+            self.misses += 1
+            regexp = globTranslators[casemapping].compile(pattern)
+            if len(self) >= self.size:
+                self.popitem(last=False)
+        self[key] = regexp
+        return regexp
+
+_reCache = PatternCache(512)
+def cachedPattern(f):
+    """Use cached regexp object or compile a new one from pattern."""
+    def getRegexp(pattern, *arg, **kwargs):
+        regexp = _reCache.compile(pattern, kwargs.get('casemapping'))
         return f(regexp, *arg)
     return getRegexp
 
 def hostmaskPattern(f):
     """Check if pattern is for match a hostmask and remove ban forward if there's one."""
-    def checkPattern(pattern, arg):
+    def checkPattern(pattern, arg, **kwargs):
         # XXX this needs a refactor
         if is_hostmask(pattern):
             # nick!user@host$#channel
@@ -501,13 +565,13 @@ def hostmaskPattern(f):
             elif not is_hostmask(arg):
                 return ''
 
-            rt = f(pattern, arg)
+            rt = f(pattern, arg, **kwargs)
             # this doesn't match any mask in args with a channel forward
             pattern += '$*'
             if isinstance(arg, list):
-                rt.extend(f(pattern, arg))
+                rt.extend(f(pattern, arg, **kwargs))
             elif not rt:
-                rt = f(pattern, arg)
+                rt = f(pattern, arg, **kwargs)
             return rt
 
         return ''
@@ -1182,8 +1246,8 @@ class CaseInsensibleDict(dict):
     def __contains__(self, k):
         return dict.__contains__(self, self.key(k))
 
-    def pop(self, k):
-        return dict.pop(self, self.key(k))
+    def pop(self, k, *args):
+        return dict.pop(self, self.key(k), *args)
 
 class CaseInsensibleDefaultDict(defaultdict, CaseInsensibleDict):
     pass
@@ -1299,8 +1363,21 @@ class MaskObject(object):
 
 class MaskList(CaseInsensibleDict):
     """Single list of masks"""
+    synced = 0
+    # if the list needs to be written to the mask store
+    changed = False
+
     def __init__(self, server, channel):
         self.synced = 0
+        self.changed = True
+
+    def __setitem__(self, mask, ban):
+        CaseInsensibleDict.__setitem__(self, mask, ban)
+        self.changed = True
+
+    def __delitem__(self, mask):
+        CaseInsensibleDict.__delitem__(self, mask)
+        self.changed = True
 
     def add(self, mask, **kwargs):
         if mask in self:
@@ -1309,10 +1386,26 @@ class MaskList(CaseInsensibleDict):
             for attr, value in kwargs.items():
                 if value and not getattr(ban, attr):
                     setattr(ban, attr, value)
+                    self.changed = True
         else:
             ban = self[mask] = MaskObject(mask, **kwargs)
         return ban
 
+    def dumps(self):
+        """Returns masks serialized for the mask store, one per line."""
+        return '\n'.join([ ' '.join((ban.mask,
+                                     ban.operator or '',
+                                     str(ban.date),
+                                     str(ban.expires),
+                                     ','.join(ban.hostmask))) for ban in self.values() ])
+
+    def loads(self, data):
+        for line in data.split('\n'):
+            mask, op, date, expires, hostmask = line.split(' ')
+            hostmask = [ s for s in hostmask.split(',') if s ]
+            self[mask] = MaskObject(mask, hostmask, op, date, expires)
+        self.changed = False
+
 #    def searchByNick(self, nick):
 #        try:
 #            hostmask = userCache.getHostmask(nick, self.server, self.channel)
@@ -1331,7 +1424,66 @@ class MaskList(CaseInsensibleDict):
         pass
 
 class MaskCache(ServerChannelDict):
-    """Keeps a cache of masks for different channels."""
+    """Keeps a cache of masks for different channels, loaded from the mask store
+    when first used."""
+    mode = ''
+    store = None
+
+    def __init__(self, mode='', store=None):
+        self.mode = mode
+        self.store = store
+
+    def _load(self, key):
+        if not self.store:
+            return None
+        server, channel = key
+        data = self.store.load(self.mode, server, channel)
+        if data is None:
+            return None
+        masklist = MaskList(server, channel)
+        if data:
+            masklist.loads(data)
+        masklist.changed = False
+        ServerChannelDict.__setitem__(self, key, masklist)
+        return masklist
+
+    def __getitem__(self, key):
+        try:
+            return ServerChannelDict.__getitem__(self, key)
+        except KeyError:
+            masklist = self._load(key)
+            if masklist is None:
+                raise
+            return masklist
+
+    def __contains__(self, key):
+        return ServerChannelDict.__contains__(self, key) or self._load(key) is not None
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        ServerChannelDict.__delitem__(self, key)
+        if self.store:
+            self.store.delete(self.mode, *key)
+
+    def purge(self):
+        ServerChannelDict.purge(self)
+        if self.store:
+            # lists that weren't loaded
+            for key in self.store.channels(self.mode):
+                if key not in chanopChannels:
+                    debug('removing %s mask list, not in watchlist.', key)
+                    self.store.delete(self.mode, *key)
+
+    def flush(self):
+        """Writes changed mask lists to the mask store."""
+        if not self.store:
+            return
+        for (server, channel), masklist in self.items():
+            if masklist.changed:
+                self.store.save(self.mode, server, channel, masklist.dumps())
+                masklist.changed = False
+
     def add(self, server, channel, mask, **kwargs):
         """Adds a ban to (server, channel) banlist."""
         key = (server, channel)
@@ -1351,26 +1503,58 @@ class MaskCache(ServerChannelDict):
         except KeyError:
             pass
 
-class ChanopCache(Shelf):
+class MaskStore(object):
+    """On-disk store of mask lists, with one record for each mode and channel, so
+    changing a list doesn't rewrite the others."""
     def __init__(self, filename):
         path = os.path.join(weechat.info_get('weechat_dir', ''), filename)
-        Shelf.__init__(self, path, writeback=True)
+        self.db = dbm.open(path, 'c')
+
+    def key(self, mode, server, channel):
+        return IRClower('%s %s %s' % (mode, server, channel))
+
+    def load(self, mode, server, channel):
+        """Returns serialized mask list or None if there isn't one."""
+        try:
+            return self.db[self.key(mode, server, channel)]
+        except KeyError:
+            return None
+
+    def save(self, mode, server, channel, data):
+        self.db[self.key(mode, server, channel)] = data
+
+    def delete(self, mode, server, channel):
+        try:
+            del self.db[self.key(mode, server, channel)]
+        except KeyError:
+            pass
+
+    def channels(self, mode):
+        """Returns (server, channel) pairs of all stored lists of mode."""
+        L = []
+        for key in self.db.keys():
+            m, server, channel = key.split(' ')
+            if m == mode:
+                L.append((server, channel))
+        return L
+
+    def sync(self):
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
 
-class ModeCache(ChanopCache):
+    def close(self):
+        self.db.close()
+
+class ModeCache(dict):
     """class for store channel modes lists."""
     def __init__(self, filename):
-        ChanopCache.__init__(self, filename)
+        self.store = MaskStore(filename)
         self.modes = set()
         self.map = CaseInsensibleDict()
 
-        # reset all sync timers
-        for cache in self.values():
-            for masklist in cache.values():
-                masklist.synced = 0
-
     def registerMode(self, mode, *args):
         if mode not in self:
-            cache = MaskCache()
+            cache = MaskCache(mode, self.store)
             self[mode] = cache
 
         if mode not in self.modes:
@@ -1382,9 +1566,9 @@ class ModeCache(ChanopCache):
 
     def __getitem__(self, mode):
         try:
-            return ChanopCache.__getitem__(self, mode)
+            return dict.__getitem__(self, mode)
         except KeyError:
-            return ChanopCache.__getitem__(self, self.map[mode])
+            return dict.__getitem__(self, self.map[mode])
 
     def add(self, server, channel, mode, mask, **kwargs):
         assert mode in self.modes
@@ -1397,10 +1581,19 @@ class ModeCache(ChanopCache):
         for cache in self.values():
             cache.purge()
 
+    def flush(self):
+        """Writes changed mask lists to disk."""
+        for cache in self.values():
+            cache.flush()
+        self.store.sync()
+
+    def close(self):
+        self.flush()
+        self.store.close()
+
 class MaskSync(object):
     """Class for fetch and sync bans of any channel and mode."""
     __name__ = ''
-    _hide_msg = False
 
     _hook_mask = ''
     _hook_end = ''
@@ -1409,10 +1602,29 @@ class MaskSync(object):
     _hook_quiet_mask = ''
     _hook_quiet_end = ''
 
-    # sync queue stuff
-    queue = []
+    _hook_no_channel = ''
+    _hook_not_on_channel = ''
+    _hook_not_op = ''
+    _hook_disconnect = ''
+
+    # seconds a synced list is considered up to date
+    _fresh_time = 60
+    # seconds we wait for a list before giving up
+    _timeout = 60
+    # milliseconds we wait for more lists to request before sending
+    _delay = 500
+    # seconds between checks for lists that timed out, while there're lists in flight
+    _reap_interval = 10
+
+    # sync queue stuff, for each server, lists waiting to be requested and lists
+    # requested but not received yet.
+    queue = CaseInsensibleDefaultDict(list)
+    _inflight = CaseInsensibleDefaultDict(CaseInsensibleDict)
     _maskbuffer = CaseInsensibleDefaultDict(list)
     _callback = CaseInsensibleDict()
+    _timers = CaseInsensibleDict()
+    _reapers = CaseInsensibleDict()
+    stats = CaseInsensibleDict()
 
     def hook(self):
         # 367 - ban mask
@@ -1428,12 +1640,27 @@ class MaskSync(object):
                 weechat.hook_modifier('irc_in_728', callback(self._maskCallback), '')
         self._hook_quiet_end = \
                 weechat.hook_modifier('irc_in_729', callback(self._endCallback), '')
+        # 403 - no such channel
+        # 442 - not on channel
+        # 482 - not channel operator
+        self._hook_no_channel = \
+                weechat.hook_modifier('irc_in_403', callback(self._errorCallback), '')
+        self._hook_not_on_channel = \
+                weechat.hook_modifier('irc_in_442', callback(self._errorCallback), '')
+        self._hook_not_op = \
+                weechat.hook_modifier('irc_in_482', callback(self._errorCallback), '')
+        self._hook_disconnect = weechat.hook_signal('irc_server_disconnected',
+                callback(self._disconnectCallback), '')
 
     def unhook(self):
         for hook in ('_hook_mask',
                      '_hook_end',
                      '_hook_quiet_mask',
-                     '_hook_quiet_end'):
+                     '_hook_quiet_end',
+                     '_hook_no_channel',
+                     '_hook_not_on_channel',
+                     '_hook_not_op',
+                     '_hook_disconnect'):
             attr = getattr(self, hook)
             if attr:
                 weechat.unhook(attr)
@@ -1454,81 +1681,193 @@ class MaskSync(object):
         # check the last time we did this
         try:
             masklist = maskCache[key]
-            if (now() - masklist.synced) < 60:
+            if (now() - masklist.synced) < self._fresh_time:
                 # don't fetch again
                 return
         except KeyError:
             pass
 
-        if not self.queue:
-            self.queue.append((server, channel, mode))
-            self._fetch(server, channel, mode)
-        elif (server, channel, mode) not in self.queue:
-            self.queue.append((server, channel, mode))
-
+        # a list requested long ago isn't coming
+        self._expire(server)
         if callback:
-            self._callback[server, channel] = callback
+            self._callback[server, channel, mode] = callback
+
+        item = (channel, mode)
+        if item in self._inflight[server]:
+            return
+        queue = self.queue[server]
+        # lists somebody is waiting for go first
+        priority = callback is not None or weechat.current_buffer() \
+                == weechat.buffer_search('irc', '%s.%s' %(server, channel))
+        if item in queue:
+            if not priority:
+                return
+            queue.remove(item)
+        if priority:
+            queue.insert(0, item)
+            self._send(server)
+        else:
+            queue.append(item)
+            self._schedule(server)
+
+    def _schedule(self, server):
+        """Sends queued lists after a while, so lists of channels joined together can
+        be grouped."""
+        if server not in self._timers:
+            self._timers[server] = weechat.hook_timer(self._delay, 0, 1,
+                    callback(self._sendTimer), server)
+
+    def _sendTimer(self, server, count):
+        del self._timers[server]
+        self._send(server)
+        return WEECHAT_RC_OK
+
+    def _reapTimer(self, server, count):
+        self._send(server)
+        if not self._inflight[server]:
+            weechat.unhook(self._reapers.pop(server))
+        return WEECHAT_RC_OK
+
+    def fetching(self, server, channel, mode):
+        """Returns True if the list is queued or was requested."""
+        item = (channel, mode)
+        return item in self._inflight[server] or item in self.queue[server]
+
+    def _drop(self, server, channel, mode):
+        """Forgets a requested list, we won't receive it."""
+        self._inflight[server].pop((channel, mode), None)
+        self._maskbuffer.pop((server, channel, mode), None)
+        self._callback.pop((server, channel, mode), None)
+
+    def _expire(self, server):
+        """Drops lists requested more than _timeout seconds ago."""
+        t = time.time()
+        for (channel, mode), sent in self._inflight[server].items():
+            if t - sent > self._timeout:
+                debug('SYNC: %s %s +%s timed out', server, channel, mode)
+                self._drop(server, channel, mode)
+
+    def _send(self, server):
+        """Requests queued lists, asking for several channels in one command if
+        TARGMAX allows it and keeping as many commands in flight as MODES."""
+        self._expire(server)
+        queue = self.queue[server]
+        inflight = self._inflight[server]
+        if not queue:
+            return
 
-    def _fetch(self, server, channel, mode):
         buffer = weechat.buffer_search('irc', 'server.%s' %server)
         if not buffer:
+            del self.queue[server]
             return
-        cmd = '/mode %s %s' %(channel, mode)
-        self._hide_msg = True
-        weechat_command(buffer, cmd)
+
+        targets = supported_maxtargets(server, 'mode')
+        window = supported_maxmodes(server) * targets
+        stats = self.getStats(server)
+        if not inflight:
+            stats.start()
+        while queue and len(inflight) < window:
+            # only one list of a channel at a time, some networks reply to quiet
+            # lists with ban list numerics and we couldn't tell them apart.
+            busy = CaseInsensibleSet([ c for c, m in inflight ])
+            ready = [ item for item in queue if item[0] not in busy ]
+            if not ready:
+                break
+            channel, mode = ready.pop(0)
+            queue.remove((channel, mode))
+            channels = [ channel ]
+            for item in ready:
+                if len(channels) >= targets or len(inflight) + len(channels) >= window:
+                    break
+                if item[1] == mode:
+                    queue.remove(item)
+                    channels.append(item[0])
+            t = time.time()
+            for channel in channels:
+                inflight[channel, mode] = t
+            stats.requests += len(channels)
+            weechat_command(buffer, '/mode %s %s' %(','.join(channels), mode))
+        if inflight and server not in self._reapers:
+            # replies can get lost, keep checking until every list arrives or times out
+            self._reapers[server] = weechat.hook_timer(self._reap_interval * 1000, 0, 0,
+                    callback(self._reapTimer), server)
+
+    def _requested(self, server, channel, mode):
+        """Returns the mode we requested for channel, some networks reply to
+        quiet lists with ban list numerics."""
+        inflight = self._inflight[server]
+        if (channel, mode) in inflight:
+            return mode
+        for c, m in inflight:
+            if c == channel:
+                return m
+        return mode
+
+    def getStats(self, server):
+        try:
+            return self.stats[server]
+        except KeyError:
+            stats = self.stats[server] = SyncStats()
+            return stats
 
     def _maskCallback(self, data, modifier, modifier_data, string):
         """callback for store a single mask."""
         #debug("MASK %s: %s %s", modifier, modifier_data, string)
         args = string.split()
-        if self.queue:
-            server, channel, _ = self.queue[0]
-        else:
-            server, channel = modifier_data, args[3]
-
+        server, channel = modifier_data, args[3]
         if modifier == 'irc_in_367':
+            mode = self._requested(server, channel, 'b')
             try:
                 mask, op, date = args[4:]
-            except IndexError:
+            except ValueError:
                 mask = args[4]
                 op = date = None
         elif modifier == 'irc_in_728':
+            mode = self._requested(server, channel, args[4])
             mask, op, date = args[5:]
 
+        if (channel, mode) not in self._inflight[server]:
+            # we didn't ask for this list
+            return string
+
         # store temporally until "end list" msg
-        self._maskbuffer[server, channel].append((mask, op, date))
-        if self._hide_msg:
-            string = ''
-        return string
+        self._maskbuffer[server, channel, mode].append((mask, op, date))
+        return ''
 
     def _endCallback(self, data, modifier, modifier_data, string):
         """callback for end of channel's mask list."""
         #debug("MASK END %s: %s %s", modifier, modifier_data, string)
-        if self.queue:
-            server, channel, mode = self.queue.pop(0)
+        args = string.split()
+        server, channel = modifier_data, args[3]
+        if modifier == 'irc_in_368':
+            mode = self._requested(server, channel, 'b')
+        elif modifier == 'irc_in_729':
+            mode = self._requested(server, channel, args[4])
         else:
-            args = string.split()
-            server, channel = modifier_data, args[3]
-            if modifier == 'irc_in_368':
-                mode = args[7]
-            elif modifier == 'irc_in_729':
-                mode = args[4]
-            else:
-                return string
+            return string
+
+        inflight = self._inflight[server]
+        if (channel, mode) not in inflight:
+            # we didn't ask for this list
+            return string
+
+        stats = self.getStats(server)
+        latency = time.time() - inflight.pop((channel, mode))
+        stats.received(latency, len(self._maskbuffer[server, channel, mode]))
 
         maskCache = modeCache[mode]
 
         # delete old masks in cache
         if (server, channel) in maskCache:
             masklist = maskCache[server, channel]
-            banmasks = [ L[0] for L in self._maskbuffer[server, channel] ]
+            banmasks = [ L[0] for L in self._maskbuffer[server, channel, mode] ]
             for mask in masklist.keys():
                 if mask not in banmasks:
                     del masklist[mask]
 
-        for banmask, op, date in self._maskbuffer[server, channel]:
+        for banmask, op, date in self._maskbuffer[server, channel, mode]:
             maskCache.add(server, channel, banmask, operator=op, date=date)
-        del self._maskbuffer[server, channel]
+        self._maskbuffer.pop((server, channel, mode), None)
         try:
             maskList = maskCache[server, channel]
         except KeyError:
@@ -1536,20 +1875,74 @@ class MaskSync(object):
         maskList.synced = now()
 
         # run hooked functions if any
-        if (server, channel) in self._callback:
-            self._callback[server, channel]()
-            del self._callback[server, channel]
-
-        if self._hide_msg:
-            string = ''
-        if self.queue:
-            next = self.queue[0]
-            self._fetch(*next)
-        else:
-            assert not self._maskbuffer, "mask buffer not empty: %s" % self._maskbuffer.keys()
-            self._hide_msg = False
+        if (server, channel, mode) in self._callback:
+            self._callback.pop((server, channel, mode))()
+
+        self._send(server)
+        if not inflight:
+            modeCache.flush()
+            debug('SYNC: %s %s', server, stats)
+        return ''
+
+    def _errorCallback(self, data, modifier, modifier_data, string):
+        """callback for errors about a channel, its lists we requested won't come."""
+        #debug("MASK ERROR %s: %s %s", modifier, modifier_data, string)
+        args = string.split()
+        if len(args) < 4:
+            return string
+        server, channel = modifier_data, args[3]
+        items = [ item for item in self._inflight[server] if item[0] == channel ]
+        if items:
+            for channel, mode in items:
+                debug('SYNC: %s %s +%s failed (%s)', server, channel, mode, args[1])
+                self._drop(server, channel, mode)
+            self._send(server)
         return string
 
+    def _disconnectCallback(self, data, signal, signal_data):
+        """callback for server disconnection, forgets its queued and requested lists."""
+        server = signal_data
+        for hooks in (self._timers, self._reapers):
+            if server in hooks:
+                weechat.unhook(hooks.pop(server))
+        self.queue.pop(server, None)
+        for channel, mode in self._inflight[server].keys():
+            self._drop(server, channel, mode)
+        return WEECHAT_RC_OK
+
+class SyncStats(object):
+    """Counters of mask lists synced in a server."""
+    def __init__(self):
+        self.requests = 0
+        self.lists = 0
+        self.masks = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        # lists received and seconds taken in the last burst of requests
+        self.burst = 0
+        self.elapsed = 0.0
+        self._start = time.time()
+
+    def start(self):
+        self.burst = 0
+        self.elapsed = 0.0
+        self._start = time.time()
+
+    def received(self, latency, masks):
+        self.lists += 1
+        self.masks += masks
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.burst += 1
+        self.elapsed = time.time() - self._start
+
+    def __str__(self):
+        if not self.lists:
+            return '%s lists requested, none received' % self.requests
+        return '%s/%s lists, %s masks, last %s lists in %.1fs, latency avg %.2fs max %.2fs' \
+                % (self.lists, self.requests, self.masks, self.burst, self.elapsed,
+                   self.latency / self.lists, self.max_latency)
+
 maskSync = MaskSync()
 
 # -----------------------------------------------------------------------------
@@ -1585,6 +1978,97 @@ class UserObject(object):
     def __repr__(self):
         return '<UserObject(%s)>' %(self.hostmask or self.nick)
 
+_wildcardRe = re.compile(r'[*?]')
+# folds every casemapping, so the buckets of a mask hold all it can match.
+_indexFold = globTranslators['rfc1459'].fold
+
+class HostmaskIndex(object):
+    """Buckets the hostmasks of a channel by host, host suffix and ident, so a banmask
+    is only tested against the hostmasks its literal parts allow."""
+    def __init__(self, users=()):
+        self.count = defaultdict(int)
+        self.current = defaultdict(int)
+        self.hosts = defaultdict(set)
+        self.suffixes = defaultdict(set)
+        self.idents = defaultdict(set)
+        # hostmasks we can't split, always tested.
+        self.other = set()
+        for user in users:
+            self.add(user)
+
+    def _keys(self, hostmask):
+        if '$' in hostmask or hostmask.count('!') != 1 or hostmask.count('@') != 1:
+            return None
+        ident, host = hostmask[hostmask.find('!') + 1:].translate(_indexFold).split('@')
+        # 'a.b.example.com' => 'b.example.com', 'example.com', 'com'
+        labels = host.split('.')
+        keys = [ (self.suffixes, '.'.join(labels[i:])) for i in range(1, len(labels)) ]
+        keys.append((self.hosts, host))
+        keys.append((self.idents, ident))
+        return keys
+
+    def add(self, user):
+        for hostmask in user._hostmask:
+            self.count[hostmask] += 1
+            if self.count[hostmask] > 1:
+                continue
+            keys = self._keys(hostmask)
+            if keys is None:
+                self.other.add(hostmask)
+                continue
+            for bucket, key in keys:
+                bucket[key].add(hostmask)
+        if user._hostmask:
+            self.current[user.hostmask] += 1
+
+    def remove(self, user):
+        if user._hostmask:
+            hostmask = user.hostmask
+            self.current[hostmask] -= 1
+            if self.current[hostmask] < 1:
+                del self.current[hostmask]
+        for hostmask in user._hostmask:
+            self.count[hostmask] -= 1
+            if self.count[hostmask] > 0:
+                continue
+            del self.count[hostmask]
+            keys = self._keys(hostmask)
+            if keys is None:
+                self.other.discard(hostmask)
+                continue
+            for bucket, key in keys:
+                bucket[key].discard(hostmask)
+                if not bucket[key]:
+                    del bucket[key]
+
+    def candidates(self, mask, all=False):
+        """Returns the hostmasks that mask might match, or None if the mask hasn't
+        enough literal parts and all hostmasks must be tested."""
+        if not is_hostmask(mask):
+            return []
+        if '$' in mask:
+            mask = mask.partition('$')[0]
+        if mask.count('!') != 1 or mask.count('@') != 1:
+            return None
+        ident, host = mask[mask.find('!') + 1:].translate(_indexFold).split('@')
+        buckets = []
+        if not _wildcardRe.search(host):
+            buckets.append(self.hosts.get(host, ()))
+        else:
+            # '*.example.com' or '*foo.example.com' => 'example.com'
+            suffix = _wildcardRe.split(host)[-1].partition('.')[2]
+            if suffix:
+                buckets.append(self.suffixes.get(suffix, ()))
+        if not _wildcardRe.search(ident):
+            buckets.append(self.idents.get(ident, ()))
+        if not buckets:
+            return None
+        L = list(min(buckets, key=len))
+        L.extend(self.other)
+        if not all:
+            L = [ hostmask for hostmask in L if hostmask in self.current ]
+        return L
+
 class ServerUserList(CaseInsensibleDict):
     def __init__(self, server):
         self.server = server
@@ -1610,15 +2094,27 @@ class UserList(ServerUserList):
         self.channel = channel
         self._purge_list = CaseInsensibleDict()
         self._purge_time = 3600*2 # 2 hours
+        self._index = None
 
     def __setitem__(self, nick, user):
         #debug('%s %s: join, %s', self.server, self.channel, nick)
+        index = self._index
         if nick not in self:
             user._channels += 1
+        elif index:
+            index.remove(self[nick])
         if nick in self._purge_list:
             #debug(' - removed from purge list')
             del self._purge_list[nick]
         ServerUserList.__setitem__(self, nick, user)
+        if index:
+            index.add(user)
+
+    def __delitem__(self, nick):
+        index = self._index
+        if index and nick in self:
+            index.remove(self[nick])
+        ServerUserList.__delitem__(self, nick)
 
     def part(self, nick):
         try:
@@ -1645,6 +2141,18 @@ class UserList(ServerUserList):
             # only current hostmasks
             return [ user.hostmask for user in users if user._hostmask ]
 
+    def match(self, mask, all=False):
+        """Returns the hostmasks matched by mask, like hostmask_match_list but
+        looking up candidates in the hostmask index."""
+        index = self._index
+        if not index:
+            index = self._index = HostmaskIndex(ServerUserList.values(self))
+        hostmasks = index.candidates(mask, all)
+        if hostmasks is None:
+            hostmasks = self.hostmasks(all=all)
+        casemapping = get_isupport_value(self.server, 'casemapping')
+        return hostmask_match_list(mask, hostmasks, casemapping=casemapping)
+
     def nicks(self, *args, **kwargs):
 #        if not all(self.itervalues()):
 #            userCache.who(self.server, self.channel)
@@ -1675,8 +2183,44 @@ class UserList(ServerUserList):
 class UserCache(ServerChannelDict):
     __name__ = ''
     servercache = CaseInsensibleDict()
-    _hook_who = _hook_who_end = None
+    _hook_who = _hook_whox = _hook_who_end = _hook_disconnect = ''
+    # channels we did a /who, so we don't repeat it.
     _channels = CaseInsensibleSet()
+    # for each server, channels waiting for a /who and the one requested, only one
+    # at a time.
+    _whoQueue = CaseInsensibleDefaultDict(list)
+    _whoInflight = CaseInsensibleDict()
+    # token for tell our WHOX replies apart
+    _whoxToken = '586'
+    # seconds we wait for a /who before giving up
+    _whoTimeout = 60
+    # seconds between checks for a /who that timed out, while one is in flight
+    _whoReapInterval = 10
+    _whoReapers = CaseInsensibleDict()
+
+    def hook(self):
+        # 352 - who reply
+        # 354 - whox reply
+        # 315 - end of who
+        self.unhook()
+        self._hook_who = \
+                weechat.hook_modifier('irc_in_352', callback(self._whoCallback), '')
+        self._hook_whox = \
+                weechat.hook_modifier('irc_in_354', callback(self._whoxCallback), '')
+        self._hook_who_end = \
+                weechat.hook_modifier('irc_in_315', callback(self._endWhoCallback), '')
+        self._hook_disconnect = weechat.hook_signal('irc_server_disconnected',
+                callback(self._disconnectCallback), '')
+
+    def unhook(self):
+        for hook in ('_hook_who',
+                     '_hook_whox',
+                     '_hook_who_end',
+                     '_hook_disconnect'):
+            attr = getattr(self, hook)
+            if attr:
+                weechat.unhook(attr)
+                setattr(self, hook, '')
 
     def generateCache(self, server, channel):
         debug('* building cache: %s %s', server, channel)
@@ -1701,18 +2245,55 @@ class UserCache(ServerChannelDict):
         debug("new cache of %s users", len(users))
         return users
 
+    def reset(self, server, channel):
+        """Starts an empty user list for channel, filled by NAMES, /who and joins."""
+        key = (server, channel)
+        if key in self:
+            del self[key]
+        self[key] = UserList(server, channel)
+        if key in self._channels:
+            self._channels.remove(key)
+        self.who(server, channel)
+
+    def add(self, server, channel, nick, hostmask):
+        """Updates user and adds it to the channel's list if we have one."""
+        user = self.remember(server, nick, hostmask)
+        key = (server, channel)
+        if key in self:
+            users = self[key]
+            if nick not in users or users[nick] is not user:
+                users[nick] = user
+        return user
+
     def remember(self, server, nick, hostmask):
         cache = self[server]
         try:
             user = cache[nick]
             if hostmask:
+                indexes = []
+                if hostmask != user.hostmask:
+                    # the user is indexed by its hostmasks in the channels it is in
+                    indexes = self._hostmaskIndexes(server, nick, user)
+                for index in indexes:
+                    index.remove(user)
                 user.update(hostmask)
+                for index in indexes:
+                    index.add(user)
         except KeyError:
             #debug("%s: new user %s %s", server, nick, hostmask)
             user = UserObject(nick, hostmask)
             cache[nick] = user
         return user
 
+    def _hostmaskIndexes(self, server, nick, user):
+        """Returns the hostmask indexes of the channels where nick is user."""
+        L = []
+        for channel in self.getChannels(server):
+            users = ServerChannelDict.__getitem__(self, (server, channel))
+            if users._index and nick in users and users[nick] is user:
+                L.append(users._index)
+        return L
+
     def __getitem__(self, k):
         if isinstance(k, tuple):
             try:
@@ -1730,7 +2311,7 @@ class UserCache(ServerChannelDict):
         # when we delete a channel, we need to reduce user._channels count
         # so they can be purged later.
         #debug('forgeting about %s', k)
-        for user in self[k].values():
+        for user in ServerUserList.values(self[k]):
             user._channels -= 1
         ServerChannelDict.__delitem__(self, k)
 
@@ -1741,50 +2322,103 @@ class UserCache(ServerChannelDict):
         return self[server].getHostmask(nick)
 
     def who(self, server, channel):
-        if self._hook_who:
-            return
-
+        """Queues a /who of channel, with WHOX if the server supports it."""
         if (server, channel) in self._channels:
             return
 
         self._channels.add((server, channel))
+        queue = self._whoQueue[server]
+        channel = CaseInsensibleString(channel)
+        if channel not in queue:
+            queue.append(channel)
+        self._whoNext(server)
+
+    def _whoNext(self, server):
+        if server in self._whoInflight:
+            channel, sent = self._whoInflight[server]
+            if now() - sent < self._whoTimeout:
+                return
+            debug('WHO: %s %s timed out', server, channel)
+            del self._whoInflight[server]
 
-        key = ('%s.%s' %(server, channel)).lower()
-        self._hook_who = weechat.hook_modifier(
-                'irc_in_352', callback(self._whoCallback), key)
-        self._hook_who_end = weechat.hook_modifier(
-                'irc_in_315', callback(self._endWhoCallback), key)
-
+        queue = self._whoQueue[server]
+        if not queue:
+            return
         buffer = weechat.buffer_search('irc', 'server.%s' %server)
-        weechat_command(buffer, '/who %s' % channel)
+        if not buffer:
+            del self._whoQueue[server]
+            return
+
+        channel = queue.pop(0)
+        self._whoInflight[server] = (channel, now())
+        if supported_whox(server):
+            # we only need channel, user, host and nick
+            weechat_command(buffer, '/who %s %%tcuhn,%s' %(channel, self._whoxToken))
+        else:
+            weechat_command(buffer, '/who %s' % channel)
+        if server not in self._whoReapers:
+            # the reply can get lost, keep checking until it arrives or times out
+            self._whoReapers[server] = weechat.hook_timer(self._whoReapInterval * 1000,
+                    0, 0, callback(self._whoReapTimer), server)
+
+    def _whoReapTimer(self, server, count):
+        self._whoNext(server)
+        if server not in self._whoInflight:
+            weechat.unhook(self._whoReapers.pop(server))
+        return WEECHAT_RC_OK
+
+    def _whoRequested(self, server, channel):
+        try:
+            return self._whoInflight[server][0] == channel
+        except KeyError:
+            return False
 
     def _whoCallback(self, data, modifier, modifier_data, string):
         #debug('%s %s %s', modifier, modifier_data, string)
         args = string.split()
         server, channel = modifier_data, args[3]
-        key = ('%s.%s' %(server, channel)).lower()
-        if key != data:
+        if not self._whoRequested(server, channel):
             return string
 
         nick, user, host = args[7], args[4], args[5]
         hostmask = '%s!%s@%s' %(nick, user, host)
         debug('WHO: %s', hostmask)
-        self.remember(server, nick, hostmask)
+        self.add(server, channel, nick, hostmask)
+        return ''
+
+    def _whoxCallback(self, data, modifier, modifier_data, string):
+        #debug('%s %s %s', modifier, modifier_data, string)
+        args = string.split()
+        server = modifier_data
+        if args[3] != self._whoxToken or not self._whoRequested(server, args[4]):
+            return string
+
+        channel, user, host, nick = args[4:8]
+        hostmask = '%s!%s@%s' %(nick, user, host)
+        debug('WHOX: %s', hostmask)
+        self.add(server, channel, nick, hostmask)
         return ''
 
     def _endWhoCallback(self, data, modifier, modifier_data, string):
         args = string.split()
         server, channel = modifier_data, args[3]
-        key = ('%s.%s' %(server, channel)).lower()
-        if key != data:
+        if not self._whoRequested(server, channel):
             return string
 
         debug('WHO: end.')
-        weechat.unhook(self._hook_who)
-        weechat.unhook(self._hook_who_end)
-        self._hook_who = self._hook_who_end = None
+        del self._whoInflight[server]
+        self._whoNext(server)
         return ''
 
+    def _disconnectCallback(self, data, signal, signal_data):
+        """callback for server disconnection, forgets its queued and requested /who."""
+        server = signal_data
+        if server in self._whoReapers:
+            weechat.unhook(self._whoReapers.pop(server))
+        self._whoQueue.pop(server, None)
+        self._whoInflight.pop(server, None)
+        return WEECHAT_RC_OK
+
     def purge(self):
         ServerChannelDict.purge(self)
         for cache in self.servercache.values():
@@ -2541,6 +3175,25 @@ def supported_maxmodes(server):
         return 1
     return max
 
+def supported_maxtargets(server, command):
+    """Returns max targets number supported by server for command."""
+    targmax = get_isupport_value(server, 'targmax')
+    for s in targmax.split(','):
+        name, _, n = s.partition(':')
+        if name.lower() == command.lower():
+            try:
+                return max(int(n), 1)
+            except ValueError:
+                # no limit, but lets be reasonable
+                return 4
+    return 1
+
+def supported_whox(server):
+    """Returns whether server supports WHOX."""
+    if weechat.info_get('irc_server_isupport', '%s,WHOX' %server):
+        return True
+    return 'whox' in isupport.get(server, ())
+
 def isupport_cb(data, signal, signal_data):
     """Callback used for catch isupport msg if current version of WeeChat doesn't
     support it."""
@@ -2560,6 +3213,8 @@ def isupport_cb(data, signal, signal_data):
             config = 'isupport.%s.%s' %(server, k)
             weechat.config_set_plugin(config, v)
             d[k] = v
+        elif k == 'whox':
+            d[k] = v
     isupport[server] = d
     return WEECHAT_RC_OK
 
@@ -2600,12 +3255,10 @@ def mode_cb(server, channel, nick, opHostmask, signal_data):
 
     # check if channel is in watchlist
     key = (server, channel)
-    allkeys = CaseInsensibleSet()
-    for maskCache in modeCache.values():
-        allkeys.update(maskCache)
-        if key not in allkeys and key not in chanopChannels:
-            # from a channel we're not tracking
-            return WEECHAT_RC_OK
+    if key not in chanopChannels \
+            and not [ maskCache for maskCache in modeCache.values() if key in maskCache ]:
+        # from a channel we're not tracking
+        return WEECHAT_RC_OK
 
     prefix = get_isupport_value(server, 'prefix')
     chanmodes = get_isupport_value(server, 'chanmodes')
@@ -2640,7 +3293,7 @@ def mode_cb(server, channel, nick, opHostmask, signal_data):
     for action, mode, mask in chanmode_list:
         debug('MODE: %s%s %s %s', action, mode, mask, opHostmask)
         if action == '+':
-            hostmask = hostmask_match_list(mask, userCache[key].hostmasks())
+            hostmask = userCache[key].match(mask)
             if hostmask:
                 affected_users.extend(hostmask)
             if mask != '*!*@*':
@@ -2652,6 +3305,7 @@ def mode_cb(server, channel, nick, opHostmask, signal_data):
             modeCache.add(server, channel, mode, mask, operator=opHostmask, hostmask=hostmask)
         elif action == '-':
             modeCache.remove(server, channel, mode, mask)
+    modeCache.flush()
 
     if affected_users and get_config_boolean('display_affected',
             get_function=get_config_specific, server=server, channel=channel):
@@ -2663,17 +3317,39 @@ def mode_cb(server, channel, nick, opHostmask, signal_data):
 @signal_parse
 def join_cb(server, channel, nick, hostmask, signal_data):
     if weechat.info_get('irc_nick', server) == nick:
-        # we're joining the channel, the cache is no longer valid
-        #userCache.generateCache(server, channel)
-        try:
-            del userCache[server, channel]
-        except KeyError:
-            pass
+        # we're joining the channel, the cache is no longer valid, NAMES and /who
+        # will fill a new one.
+        userCache.reset(server, channel)
+        # and get the channel's masks
+        for mode in supported_modes(server):
+            maskSync.fetch(server, channel, mode)
         return WEECHAT_RC_OK
     user = userCache.remember(server, nick, hostmask)
     userCache[server, channel][nick] = user
     return WEECHAT_RC_OK
 
+@catchExceptions
+def names_cb(data, signal, signal_data):
+    #:server 353 m4v = #test :@m4v +dude asd
+    server = signal[:signal.find(',')]
+    args, _, names = signal_data.partition(' :')
+    channel = args.split()[-1]
+    if (server, channel) not in userCache:
+        return WEECHAT_RC_OK
+    prefix = get_isupport_value(server, 'prefix')
+    prefix = prefix[prefix.find(')') + 1:]
+    for name in names.split():
+        # with userhost-in-names names are hostmasks
+        name = name.lstrip(prefix)
+        if '!' in name:
+            hostmask = name
+            nick = name[:name.find('!')]
+        else:
+            hostmask = ''
+            nick = name
+        userCache.add(server, channel, nick, hostmask)
+    return WEECHAT_RC_OK
+
 @signal_parse
 def part_cb(server, channel, nick, hostmask, signal_data):
     userCache.remember(server, nick, hostmask)
@@ -2704,7 +3380,10 @@ def garbage_collector_cb(data, counter):
     expired users that parted.
     """
     debug('* flushing caches')
+    debug('pattern cache: %s patterns, %s hits, %s misses', len(_reCache),
+            _reCache.hits, _reCache.misses)
     modeCache.purge()
+    modeCache.flush()
     userCache.purge()
 
     if weechat.config_get_plugin('debug'):
@@ -2828,7 +3507,7 @@ def unban_mask_cmpl(mode, completion_item, buffer, completion):
 
     if key not in maskCache or not maskCache[key].synced:
         # do completion after fetching marks
-        if not maskSync.queue:
+        if not maskSync.fetching(server, channel, mode):
             def callback():
                 masklist = maskCache[key]
                 if chanop_bar:
@@ -3019,10 +3698,9 @@ def item_ban_matches_cb(data, item, window):
     #debug('ban matches item: %s', masks)
 
     affected = []
-    hostmasks = users.hostmasks(all=True)
     for mask in masks:
         if is_hostmask(mask):
-            affected.extend(hostmask_match_list(mask, hostmasks))
+            affected.extend(users.match(mask, all=True))
         elif mask in users:
             affected.append(mask)
     #debug('ban matches item: %s', affected)
@@ -3076,6 +3754,7 @@ def input_content_cb(data, modifier, modifier_data, string):
 # Main
 
 def unload_chanop():
+    modeCache.close()
     if chanop_bar:
         # we don't remove it, so custom options configs aren't lost
         chanop_bar.hide()
@@ -3136,12 +3815,40 @@ if __name__ == '__main__' and import_ok and \
         if not weechat.config_is_set_plugin(opt):
             weechat.config_set_plugin(opt, val)
 
-    modeCache = ModeCache('chanop_mode_cache.dat')
+    modeCache = ModeCache('chanop_masks.db')
     modeCache.registerMode('b', 'ban', 'bans')
     modeCache.registerMode('q', 'quiet', 'quiets')
 
     # -------------------------------------------------------------------------
-    # remove old chanmask config and save them in shelf
+    # move masks from the old shelf cache to the mask store
+
+    path = os.path.join(weechat.info_get('weechat_dir', ''), 'chanop_mode_cache.dat')
+    try:
+        shelf = Shelf(path, 'r')
+    except dbm.error:
+        # no old cache
+        shelf = None
+    if shelf is not None:
+        try:
+            for mode, cache in shelf.items():
+                if mode not in modeCache:
+                    continue
+                for (server, channel), masklist in cache.items():
+                    if (server, channel) not in modeCache[mode]:
+                        masklist.synced = 0
+                        masklist.changed = True
+                        dict.__setitem__(modeCache[mode], (server, channel), masklist)
+            shelf.close()
+            modeCache.flush()
+            # depending of the dbm module the shelf is one file or several
+            for name in (path, path + '.db', path + '.dat', path + '.dir', path + '.bak'):
+                if os.path.exists(name):
+                    os.rename(name, name + '.old')
+        except Exception as e:
+            error('Error reading old mask cache %s: %s' % (path, e))
+
+    # -------------------------------------------------------------------------
+    # remove old chanmask config and save them in the mask store
 
     prefix = 'python.%s.chanmask' % SCRIPT_NAME
     infolist = Infolist('option', 'plugins.var.%s.*' % prefix)
@@ -3157,12 +3864,14 @@ if __name__ == '__main__' and import_ok and \
                 masklist = cache[server, channel] = MaskList(server, channel)
         if mask in masklist:
             masklist[mask].deserialize(infolist['value'])
+            masklist.changed = True
         else:
             obj = masklist[mask] = MaskObject(mask)
             obj.deserialize(infolist['value'])
         weechat.config_unset_plugin('chanmask.%s.%s.%s.%s' \
                 % (server, channel, mode, mask))
     del infolist
+    modeCache.flush()
 
     # hook /oop /odeop
     Op().hook()
@@ -3191,6 +3900,7 @@ if __name__ == '__main__' and import_ok and \
     DeVoice().hook()
 
     maskSync.hook()
+    userCache.hook()
 
     weechat.hook_config('plugins.var.python.%s.enable_multi_kick' % SCRIPT_NAME,
             'enable_multi_kick_conf_cb', '')
@@ -3207,6 +3917,7 @@ if __name__ == '__main__' and import_ok and \
     weechat.hook_completion('chanop_hosts', 'hostnames in cache', 'hosts_cmpl', '')
 
     weechat.hook_signal('*,irc_in_join', 'join_cb', '')
+    weechat.hook_signal('*,irc_in_353', 'names_cb', '')
     weechat.hook_signal('*,irc_in_part', 'part_cb', '')
     weechat.hook_signal('*,irc_in_quit', 'quit_cb', '')
     weechat.hook_signal('*,irc_in_nick', 'nick_cb', '')
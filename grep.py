@@ -28,6 +28,10 @@
 #     Search in logs or buffers, see /help grep
 #   * /logs:
 #     Lists logs in ~/.weechat/logs, see /help logs
+#     Compressed logs (.gz, .bz2 and .xz) are searched too, xz needs python's lzma module or the
+#     xz command.
+#   * /lastlog:
+#     Search in the current buffer and show matches in it, see /help lastlog
 #
 #   Settings:
 #   * plugins.var.python.grep.clear_buffer:
@@ -48,18 +52,37 @@
 #     It can be used for force or disable background process, using '0' forces to always grep in
 #     background, while using '' (empty string) will disable it.
 #
+#   * plugins.var.python.grep.workers:
+#     Number of processes used for grepping in background. Logs are distributed among them, and
+#     big logs are split in parts, so all processes search about the same amount of data.
+#
+#   * plugins.var.python.grep.use_mmap:
+#     Search in memory mapped logs when no context lines or --invert are needed, the regexp runs
+#     over big chunks of the log instead of line by line, which is faster. Valid values: on, off
+#
+#   * plugins.var.python.grep.spill_to_disk:
+#     Only max_lines lines are kept in memory, with this option the matched lines that don't fit
+#     are written in a temporal file instead of discarded, they can be shown later with
+#     "/grep more". Valid values: on, off
+#
 #   * plugins.var.python.grep.default_tail_head:
 #     Config option for define default number of lines returned when using --head or --tail options.
 #     Can be overriden in the command with --number option.
 #
+#   * plugins.var.python.grep.index_logs:
+#     Use an index for searching in logs, only works with plain words or literal strings, any other
+#     regexp will search in the whole log. Logs are indexed with /grep --reindex, and the index is
+#     updated with new lines every time a log is searched. Valid values: on, off
+#
+#   * plugins.var.python.grep.cache_size:
+#     Results of searches in logs are kept for the next searches, about this number of lines in
+#     total. A search repeated in a log that didn't change isn't done again, and in a log that grew
+#     only the new lines are searched. Use '0' for disable it, or --no-cache in a search. It isn't
+#     used with spill_to_disk.
+#
 #
 #   TODO:
-#   * try to figure out why hook_process chokes in long outputs (using a tempfile as a
-#   workaround now)
-#   * possibly add option for defining time intervals
-#   * try to reduce memory usage when matching lots of lines
 #   * fix using "\" at the end of the regex
-#   * fix using "'" in regexs
 #
 #
 #   History:
@@ -68,6 +91,31 @@
 #   * removed log_filter option, I hardly use it now and slows down the log completer.
 #   * removed options --all and --buffer
 #   * added command /lastlog
+#   * added index for logs, see index_logs option and --reindex.
+#   * grep in background with several processes, see workers option.
+#   * results of background searches are shown while searching, no more temporal files.
+#   * --tail and --before-context don't load the whole log in memory anymore.
+#   * faster search using mmap, see use_mmap option.
+#   * lines without the literal strings required by the pattern are discarded without using the
+#     regexp.
+#   * search in compressed logs (gzip, bzip2 and xz).
+#   * added --since and --until options, logs are bisected by date instead of read whole.
+#   * the list of logs is kept between searches, only directories that changed are listed again.
+#   * only the lines that can be shown are kept in memory, see spill_to_disk option and
+#     /grep more.
+#   * lines of buffers are kept in a cache, searching in buffers doesn't read them again.
+#   * buffers are searched a slice at a time from a timer, added --merge option.
+#   * logs not searched in background are searched a slice at a time too, with progress in the
+#     title, and can be stopped with /grep stop.
+#   * --hilight colours matches in a single pass, added --hilight and --matchcase to /lastlog.
+#   * --count searches logs and buffers in blocks of lines and only counts, no line is kept.
+#   * results are printed in batches, many lines are printed a slice at a time from a timer.
+#     Coloured nicks are cached between searches.
+#   * added --nick, --date and --text options for search in the fields of lines, nicks are
+#     indexed too.
+#   * results of searches in logs are cached, see cache_size option and --no-cache.
+#   * background processes get their arguments encoded instead of in their code, fixes using
+#     quotes in patterns. Found lines are sent in batches.
 #
 #   2011-01-09
 #   version 0.7.2: bug fixes
@@ -184,10 +232,36 @@ import os
 import re
 import sys
 import time
+import io
+import bz2
+import gzip
+import struct
 import getopt
+import pipes
+import base64
+import subprocess
+import mmap
+import heapq
+import marshal
 import tempfile
+import shelve
+import sre_parse
+import sre_constants
 from os import path
-from fnmatch import fnmatch
+from glob import glob
+from array import array
+from hashlib import md5
+from fnmatch import fnmatch, translate
+from itertools import islice
+from collections import deque, OrderedDict
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 try:
     import weechat
@@ -211,6 +285,11 @@ settings = {
 'show_summary'      : 'on',
 'size_limit'        : '2048',
 'default_tail_head' : '10',
+'index_logs'        : 'off',
+'workers'           : '2',
+'use_mmap'          : 'on',
+'spill_to_disk'     : 'off',
+'cache_size'        : '20000',
 }
 
 # -------------------------------------------------------------------------
@@ -245,6 +324,13 @@ class GrepOptions(object):
                 'number': None,
                 'after_context': 0,
                 'before_context': 0,
+                'since': '',
+                'until': '',
+                'merge': False,
+                'nick': '',
+                'date': '',
+                'text': False,
+                'no_cache': False,
                 }
 
     def __getattr__(self, name):
@@ -355,6 +441,32 @@ class GrepOptions(object):
 
     invert = property(fset=setInvert)
 
+    def setSince(self, value):
+        self._options['since'] = value and parse_date(value)
+
+    since = property(fset=setSince)
+
+    def setUntil(self, value):
+        self._options['until'] = value and parse_date(value, until=True)
+
+    until = property(fset=setUntil)
+
+    def dates(self):
+        """(since, until) pair for grep_file(), or None if there's no time range."""
+        if self.since or self.until:
+            return self.since, self.until
+        return None
+
+    dates = property(dates)
+
+    def fields(self):
+        """(nick, date, text) for grep_file(), or None if there're no field filters."""
+        if self.nick or self.date or self.text:
+            return self.nick, self.date, self.text
+        return None
+
+    fields = property(fields)
+
 
 options = GrepOptions()
 
@@ -411,6 +523,10 @@ class linesDict(dict):
         for L in self.itervalues():
             L.strip_separator()
 
+    def get_stripped_lines(self):
+        """Return the sum of lines removed for saving memory."""
+        return sum([ L.stripped_lines for L in self.itervalues() ])
+
     def get_last_lines(self, n):
         total_lines = len(self)
         #debug('total: %s n: %s' %(total_lines, n))
@@ -421,17 +537,16 @@ class linesDict(dict):
             l = len(v)
             if n > 0:
                 if l > n:
-                    del v[:l-n]
-                    v.stripped_lines = l-n
+                    v.trim(n)
                 n -= l
             else:
-                del v[:]
-                v.stripped_lines = l
+                v.trim(0)
 
 class linesList(list):
     """Class for list of matches, since sometimes I need to add lines that aren't matches, I need an
     independent counter."""
     _sep = '...'
+    spill = None
     def __init__(self, *args):
         list.__init__(self, *args)
         self.matches_count = 0
@@ -471,6 +586,122 @@ class linesList(list):
             if self[-1] == s:
                 del self[-1]
 
+    def copy(self):
+        """Returns a copy of the list, with the same counters."""
+        L = self.__class__.__new__(self.__class__)
+        L.__dict__.update(self.__dict__)
+        list.extend(L, self)
+        return L
+
+    def trim(self, size):
+        """Removes all lines but the last 'size', they're passed to spill() if there's one."""
+        n = len(self) - size
+        if n > 0:
+            if self.spill:
+                self.spill(self[:n])
+            del self[:n]
+            self.stripped_lines += n
+
+class boundedLinesList(linesList):
+    """
+    linesList that keeps in memory about the last 'size' lines, older lines are removed in batches
+    with trim(). If 'first' is true the first 'size' lines are kept instead, later lines are
+    passed to 'spill' right away, or just counted if there's no spill.
+    """
+    def __init__(self, size, spill=None, first=False):
+        linesList.__init__(self)
+        self.size = size
+        self.spill = spill
+        self.first = first
+        self.overflow = False
+
+    def append(self, item):
+        if self.first:
+            if isinstance(item, str):
+                item = [ item ]
+            self.extend(item)
+        else:
+            linesList.append(self, item)
+            if len(self) > 2 * self.size:
+                self.trim(self.size)
+
+    def extend(self, L):
+        if self.first:
+            n = 0
+            if not self.overflow:
+                n = max(self.size - len(self), 0)
+                list.extend(self, L[:n])
+            if len(L) > n:
+                # once a line is left out all the next ones are too, so they're kept in order
+                self.overflow = True
+                if self.spill:
+                    self.spill(L[n:])
+                self.stripped_lines += len(L) - n
+        else:
+            list.extend(self, L)
+            if len(self) > 2 * self.size:
+                self.trim(self.size)
+
+class spillFile(object):
+    """
+    Temporal file with the matched lines that didn't fit in grep buffer, so they can be shown with
+    "/grep more". Lines are written in chunks, chunks are read sorted by the key given when
+    written, and chunks with the same key in the order they were written.
+    """
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(prefix=SCRIPT_NAME)
+        self.chunks = []  # (key, n, log, offset)
+        self.logs = {}    # log -> key, for chunks written without key
+        self.lines = 0
+        self.shown = 0
+        self.reader = None
+
+    def write(self, log, lines, key=None):
+        if not lines:
+            return
+        if key is None:
+            key = self.logs.setdefault(log, (len(self.logs), ))
+        file = self.file
+        file.seek(0, 2)
+        self.chunks.append((key, len(self.chunks), log, file.tell()))
+        marshal.dump(list(lines), file)
+        self.lines += len(lines)
+
+    def writer(self, log, key=None):
+        """Returns a function that spills lines of 'log', for linesList.spill."""
+        return lambda lines: self.write(log, lines, key)
+
+    def read(self):
+        """Yields (log, line) for each spilled line, in order."""
+        file = self.file
+        for key, n, log, offset in sorted(self.chunks):
+            file.seek(offset)
+            for line in marshal.load(file):
+                yield log, line
+
+    def next_page(self, size):
+        """Returns a list of the next 'size' (log, line) not shown."""
+        if self.reader is None:
+            self.reader = self.read()
+        page = list(islice(self.reader, size))
+        self.shown += len(page)
+        return page
+
+    def close(self):
+        self.file.close()
+
+spill_file = None
+def make_lines(log):
+    """
+    Returns the linesList for the matches of 'log', it keeps only the last max_lines lines (the
+    ones that might be shown) and the older ones are written in spill_file if there's one.
+    """
+    if options.tail:
+        # lines are found backwards, but --tail already limits how many are kept
+        return linesList()
+    spill = spill_file and spill_file.writer(log)
+    return boundedLinesList(max(get_config_int('max_lines'), 1), spill)
+
 ### Misc functions ###
 now = time.time
 def get_size(f):
@@ -479,6 +710,102 @@ def get_size(f):
     except OSError:
         return 0
 
+def is_compressed(f):
+    return f.endswith(compressed_ext)
+
+def read_vli(data, pos):
+    """Reads a xz variable length integer at 'pos' of 'data', returns (value, next pos)."""
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError('invalid integer')
+
+def get_xz_uncompressed_size(fd, end):
+    """
+    Returns the uncompressed size of the xz streams in 'fd' that end at 'end', read from the index
+    each stream has at its end, without decompressing anything.
+    """
+    size = 0
+    while end > 0:
+        # skip stream padding
+        fd.seek(end - 4)
+        while end >= 4 and fd.read(4) == '\x00' * 4:
+            end -= 4
+            fd.seek(end - 4)
+        if end < 24:
+            raise ValueError('truncated stream')
+        fd.seek(end - 12)
+        footer = fd.read(12)
+        if footer[10:] != 'YZ':
+            raise ValueError('no stream footer')
+        index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+        fd.seek(end - 12 - index_size)
+        index = fd.read(index_size)
+        if index[0] != '\x00':
+            raise ValueError('no stream index')
+        records, pos = read_vli(index, 1)
+        blocks_size = 0
+        for i in xrange(records):
+            unpadded, pos = read_vli(index, pos)
+            uncompressed, pos = read_vli(index, pos)
+            blocks_size += (unpadded + 3) & ~3
+            size += uncompressed
+        # stream header + blocks + index + footer
+        end -= 12 + blocks_size + index_size + 12
+    return size
+
+_uncompressedSizeCache = {}
+def get_uncompressed_size(f):
+    """
+    Returns the size of the compressed log 'f' once decompressed, or None if it can't be known
+    without decompressing it (like with bz2 logs).
+    """
+    try:
+        st = os.stat(f)
+    except OSError:
+        return None
+    key = (f, st.st_size, st.st_mtime)
+    try:
+        return _uncompressedSizeCache[key]
+    except KeyError:
+        pass
+    size = None
+    try:
+        if f.endswith('.gz') and st.st_size >= 4:
+            # gzip keeps the size (modulo 2^32) in its last 4 bytes
+            fd = open(f, 'rb')
+            try:
+                fd.seek(-4, 2)
+                size = struct.unpack('<I', fd.read(4))[0]
+            finally:
+                fd.close()
+        elif f.endswith('.xz'):
+            fd = open(f, 'rb')
+            try:
+                size = get_xz_uncompressed_size(fd, st.st_size)
+            finally:
+                fd.close()
+    except Exception, e:
+        debug('get_uncompressed_size: %s: %s', f, e)
+    _uncompressedSizeCache[key] = size
+    return size
+
+COMPRESSION_RATIO = 5 # a guess, logs compress very well
+def get_data_size(f):
+    """Returns the amount of data to search in log 'f', estimated for some compressed logs."""
+    if not is_compressed(f):
+        return get_size(f)
+    size = get_uncompressed_size(f)
+    if size is None:
+        return get_size(f) * COMPRESSION_RATIO
+    return size
+
 sizeDict = {0:'b', 1:'KiB', 2:'MiB', 3:'GiB', 4:'TiB'}
 def human_readable_size(size):
     power = 0
@@ -487,6 +814,33 @@ def human_readable_size(size):
         size /= 1024.0
     return '%.2f %s' %(size, sizeDict.get(power, ''))
 
+class nickColors(OrderedDict):
+    """
+    Coloured nicks of the last 'size' nicks used, by color_nick(). Kept between searches, it's
+    cleared when WeeChat's colour options change.
+    """
+    def __init__(self, size):
+        OrderedDict.__init__(self)
+        self.size = size
+
+    def get_color(self, nick):
+        try:
+            nick_c = self.pop(nick)
+        except KeyError:
+            nick_c = color_nick(nick)
+            if len(self) >= self.size:
+                # forget the least recently used
+                self.popitem(last=False)
+        self[nick] = nick_c
+        return nick_c
+
+NICK_COLORS_SIZE = 1000
+nick_colors = nickColors(NICK_COLORS_SIZE)
+
+def nick_colors_cb(data, option, value):
+    nick_colors.clear()
+    return WEECHAT_RC_OK
+
 def color_nick(nick):
     """Returns coloured nick, with coloured mode if any."""
     if not nick: return ''
@@ -580,28 +934,143 @@ def say(s, buffer=''):
 
 
 ### Log files and buffers ###
-cache_dir = {} # note: don't remove, needed for completion if the script was loaded recently
-def dir_list(dir, include_dir=False):
-    """Returns a list of files in 'dir' and its subdirs."""
-    global cache_dir
-    #debug('dir_list: listing in %s' %dir)
-    key = (dir, include_dir)
-    try:
-        return cache_dir[key]
-    except KeyError:
-        pass
-    
-    file_list = []
-    for basedir, subdirs, files in os.walk(dir):
+compressed_ext = ('.gz', '.bz2', '.xz')
+
+class pipeFile(object):
+    """Reads the output of a decompressor command like a file."""
+    def __init__(self, args):
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                        stderr=open(os.devnull, 'w'))
+        self.stdout = self.process.stdout
+        self.read = self.stdout.read
+        self.readline = self.stdout.readline
+
+    def __iter__(self):
+        return iter(self.stdout)
+
+    def close(self):
+        self.stdout.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+
+def open_log(file):
+    """Opens 'file' for reading, compressed logs are decompressed on the fly."""
+    if file.endswith('.gz'):
+        fd = gzip.GzipFile(file, 'rb')
+        # GzipFile's readline is slow, so we read with a buffer
+        return io.BufferedReader(fd, 1024*1024)
+    elif file.endswith('.bz2'):
+        return bz2.BZ2File(file, 'r', 1024*1024)
+    elif file.endswith('.xz'):
+        if not path.isfile(file):
+            raise IOError, 'No such file: %s' % file
+        if lzma:
+            return lzma.LZMAFile(file, 'r')
+        try:
+            return pipeFile(['xz', '-dc', file])
+        except OSError:
+            raise Exception, "Can't decompress '%s', install xz or python's lzma module." % file
+    return open(file, 'r')
+
+class logCatalogue(object):
+    """
+    The files in a dir tree, shared by /grep, /logs and the log completion. Each directory is
+    kept with its mtime and size, these change whenever a file is added, removed or renamed in
+    it, so refreshing only lists again the directories that changed. Files matching a pattern are
+    cached until the catalogue changes.
+    """
+    def __init__(self, dir):
+        self.dir = dir
+        self.dirs = {}      # dir -> ((mtime, size), subdirs, files)
+        self.file_list = []
+        self.file_set = set()
+        self.dir_list = []
+        self.matches = {}   # pattern -> files
+
+    def __contains__(self, file):
+        return file in self.file_set
+
+    def refresh(self):
+        """Lists again the directories that changed since last refresh."""
+        dirs = {}
+        changed = False
+        stack = [ self.dir ]
+        while stack:
+            dir = stack.pop()
+            try:
+                st = os.stat(dir)
+            except OSError:
+                # removed while we were listing
+                changed = True
+                continue
+            key = (st.st_mtime, st.st_size)
+            entry = self.dirs.get(dir)
+            if not entry or entry[0] != key:
+                changed = True
+                subdirs, files = [], []
+                try:
+                    names = os.listdir(dir)
+                except OSError:
+                    names = []
+                names.sort()
+                for name in names:
+                    file = path.join(dir, name)
+                    if path.isdir(file):
+                        # like os.walk, symlinks to dirs are listed but not walked
+                        subdirs.append((path.join(file, ''), path.islink(file)))
+                    else:
+                        files.append(file)
+                entry = (key, subdirs, files)
+            dirs[dir] = entry
+            for subdir, link in reversed(entry[1]):
+                if not link:
+                    stack.append(subdir)
+        if not changed and len(dirs) == len(self.dirs):
+            return
+        self.dirs = dirs
+        file_list, dir_list = [], []
+        stack = [ self.dir ]
+        while stack:
+            dir = stack.pop()
+            if dir not in dirs:
+                continue
+            key, subdirs, files = dirs[dir]
+            file_list.extend(files)
+            dir_list.extend([ subdir for subdir, link in subdirs ])
+            stack.extend([ subdir for subdir, link in reversed(subdirs) if not link ])
+        self.file_list = file_list
+        self.file_set = set(file_list)
+        self.dir_list = dir_list
+        self.matches = {}
+
+    def files(self, include_dir=False):
+        """Returns a list of files in the catalogue, and of its subdirs if 'include_dir'."""
         if include_dir:
-            subdirs = map(lambda s: os.path.join(s, ''), subdirs)
-            files.extend(subdirs)
-        files_path = map(lambda f: os.path.join(basedir, f), files)
-        file_list.extend(files_path)
+            return self.file_list + self.dir_list
+        return self.file_list[:]
 
-    cache_dir[key] = file_list
-    #debug('dir_list: got %s' %str(file_list))
-    return file_list
+    def match(self, pattern):
+        """Returns the files whose path, without the catalogue's dir, matches 'pattern'."""
+        try:
+            return self.matches[pattern][:]
+        except KeyError:
+            pass
+        match = re.compile(translate(pattern)).match
+        n = len(self.dir)
+        files = [ file for file in self.file_list if match(file[n:]) ]
+        self.matches[pattern] = files
+        return files[:]
+
+log_catalogue = None # note: don't remove, needed for completion if the script was loaded recently
+def get_catalogue():
+    """Returns the catalogue of the logs in WeeChat's log dir, up to date."""
+    global log_catalogue
+    home_dir = get_home()
+    if log_catalogue is None or log_catalogue.dir != home_dir:
+        log_catalogue = logCatalogue(home_dir)
+    log_catalogue.refresh()
+    return log_catalogue
 
 def get_file_by_pattern(pattern):
     """Returns all logs whose path matches <pattern>."""
@@ -613,16 +1082,7 @@ def get_file_by_pattern(pattern):
     if path.isfile(file):
         return [ file ]
     # lets see if there's a matching log
-    files = []
-    home_dir = get_home()
-    file_list = dir_list(home_dir)
-    n = len(home_dir)
-    for log in file_list:
-        basename = log[n:]
-        if fnmatch(basename, pattern):
-            files.append(log)
-    #debug('get_file_by_filename: got %s.' %file)
-    return files
+    return get_catalogue().match(pattern)
 
 def get_file_by_buffer(buffers):
     """Given a buffer pointer list, find their log's path."""
@@ -630,12 +1090,15 @@ def get_file_by_buffer(buffers):
     result = []
     infolist = weechat.infolist_get('logger_buffer', '', '')
     if not infolist: return result
+    catalogue = get_catalogue()
     try:
         while weechat.infolist_next(infolist):
             pointer = weechat.infolist_pointer(infolist, 'buffer')
             if pointer in buffers:
                 file = weechat.infolist_string(infolist, 'log_filename')
-                if weechat.infolist_integer(infolist, 'log_enabled'):
+                # the log isn't created until the buffer has something to log
+                if weechat.infolist_integer(infolist, 'log_enabled') \
+                        and (file in catalogue or path.isfile(file)):
                     #debug('get_file_by_buffer: got %s' %file)
                     result.append(file)
     finally:
@@ -685,8 +1148,310 @@ def make_regexp(pattern, matchcase=False):
         raise Exception, 'Bad pattern, %s' %e
     return regexp
 
+def required_literals(items):
+    """
+    Returns a list of sets of strings that any string matched by the parsed regexp 'items' must
+    contain, at least one string of each set.
+    """
+    required = []
+    run = []
+    def flush():
+        if run:
+            required.append(set([ ''.join(run) ]))
+            del run[:]
+
+    for op, av in items:
+        if op == sre_constants.LITERAL and av < 256:
+            run.append(chr(av))
+        elif op == sre_constants.AT:
+            # anchors don't take any char, so the literal isn't broken
+            pass
+        elif op == sre_constants.SUBPATTERN:
+            flush()
+            required.extend(required_literals(av[1]))
+        elif op == sre_constants.BRANCH:
+            flush()
+            alternatives = set()
+            for branch in av[1]:
+                best = best_literals(required_literals(branch))
+                if not best:
+                    # this branch doesn't need any literal
+                    alternatives = None
+                    break
+                alternatives.update(best)
+            if alternatives:
+                required.append(alternatives)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            flush()
+            min_repeat, max_repeat, item = av
+            if min_repeat:
+                required.extend(required_literals(item))
+        else:
+            flush()
+    flush()
+    return required
+
+def best_literals(required):
+    """Returns the set of 'required' with the longest literals, or None."""
+    best = None
+    for literals in required:
+        if best is None or min(map(len, literals)) > min(map(len, best)):
+            best = literals
+    return best
+
+class literalSet(object):
+    """
+    Matcher for a set of literals, tells if a string has any of them. Literals that contain another
+    literal of the set are redundant and removed, then each literal is looked up with 'in', which
+    in CPython beats running an automaton char by char.
+    """
+    def __init__(self, literals, ignorecase=False):
+        literals = set(literals)
+        for literal in list(literals):
+            for other in literals:
+                if other != literal and other in literal:
+                    literals.discard(literal)
+                    break
+        # shortest first, these are more likely to be found
+        self.literals = sorted(literals, key=len)
+        self.ignorecase = ignorecase
+
+    def __call__(self, s):
+        if self.ignorecase:
+            s = s.lower()
+        for literal in self.literals:
+            if literal in s:
+                return True
+        return False
+
+PREFILTER_MIN_LENGTH = 3
+_prefilterCache = {}
+def make_prefilter(regexp):
+    """
+    Returns a function that rejects quickly strings that 'regexp' can't match, by looking for the
+    literals the regexp requires. Returns None if the regexp doesn't have good literals.
+    """
+    if not regexp:
+        return None
+    key = (regexp.pattern, regexp.flags)
+    try:
+        return _prefilterCache[key]
+    except KeyError:
+        pass
+    prefilter = None
+    ignorecase = regexp.flags & re.IGNORECASE
+    if not (ignorecase and regexp.flags & (re.LOCALE | re.UNICODE)):
+        try:
+            literals = best_literals(required_literals(sre_parse.parse(regexp.pattern,
+                                                                       regexp.flags)))
+        except Exception:
+            literals = None
+        if literals and min(map(len, literals)) >= PREFILTER_MIN_LENGTH:
+            if ignorecase:
+                literals = [ s.lower() for s in literals ]
+            prefilter = literalSet(literals, ignorecase)
+    _prefilterCache[key] = prefilter
+    return prefilter
+
+_newline_categories = set((sre_constants.CATEGORY_SPACE, sre_constants.CATEGORY_NOT_DIGIT,
+                           sre_constants.CATEGORY_NOT_WORD, sre_constants.CATEGORY_LINEBREAK))
+def matches_newline(items, flags):
+    """Tells if the parsed regexp 'items' might match a newline, or uses anchors of the whole
+    string (\\A or \\Z). Errs on the side of True."""
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            if av == 10:
+                return True
+        elif op == sre_constants.NOT_LITERAL:
+            if av != 10:
+                return True
+        elif op == sre_constants.ANY:
+            if flags & re.DOTALL:
+                return True
+        elif op == sre_constants.IN:
+            found = negate = False
+            for set_op, set_av in av:
+                if set_op == sre_constants.NEGATE:
+                    negate = True
+                elif set_op == sre_constants.LITERAL:
+                    found = found or set_av == 10
+                elif set_op == sre_constants.RANGE:
+                    found = found or set_av[0] <= 10 <= set_av[1]
+                elif set_op == sre_constants.CATEGORY:
+                    found = found or set_av in _newline_categories
+                else:
+                    return True
+            if found != negate:
+                return True
+        elif op == sre_constants.AT:
+            if av in (sre_constants.AT_BEGINNING_STRING, sre_constants.AT_END_STRING):
+                return True
+        elif op == sre_constants.SUBPATTERN:
+            if matches_newline(av[1], flags):
+                return True
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                if matches_newline(branch, flags):
+                    return True
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if matches_newline(av[2], flags):
+                return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if matches_newline(av[1], flags):
+                return True
+        elif op != sre_constants.GROUPREF:
+            # a backreference matches what its group did, anything else isn't known
+            return True
+    return False
+
+_lineLocalCache = {}
+def is_line_local(regexp):
+    """
+    Tells if 'regexp' can't match a newline, then it finds the same lines if compiled with
+    re.MULTILINE and searched over several lines at once than when searched line by line.
+    """
+    key = (regexp.pattern, regexp.flags)
+    try:
+        return _lineLocalCache[key]
+    except KeyError:
+        pass
+    try:
+        local = not matches_newline(sre_parse.parse(regexp.pattern, regexp.flags),
+                                    regexp.flags)
+    except Exception:
+        local = False
+    _lineLocalCache[key] = local
+    return local
+
+NICK_MODES = '~&@%+!'
+def mask_to_regexp(mask):
+    """Converts a mask with '*' and '?' wildcards into a regexp that doesn't go past a field."""
+    L = []
+    for c in mask:
+        if c == '*':
+            L.append('[^\t\n]*')
+        elif c == '?':
+            L.append('[^\t\n]')
+        else:
+            L.append(re.escape(c))
+    return ''.join(L)
+
+def make_field_regexp(nick='', date=''):
+    """
+    Returns a regexp that matches the start of the lines whose nick and date fields match the
+    masks 'nick' and 'date', or None if there are no masks. The nick's mode is ignored, and a
+    date mask only needs to match the start of the date. The message isn't read.
+    """
+    if not (nick or date):
+        return None
+    L = [ '^', mask_to_regexp(date) ]
+    if nick:
+        L.append('[^\t\n]*\t[%s]*' % re.escape(NICK_MODES))
+        L.append(mask_to_regexp(nick.lstrip(NICK_MODES)))
+        L.append('\t')
+    return re.compile(''.join(L), re.IGNORECASE)
+
+def make_check(regexp, hilight='', exact=False, invert=False, fields=None):
+    """
+    Returns a function that checks a string like check_string(), after discarding the strings
+    that can't match with the regexp's prefilter. Anything that depends only on the search, like
+    the hilighter, is done here once instead of for every string.
+    If 'fields' (nick, date, text) is given only lines with the nick and date are checked, and
+    with 'text' only the message is searched.
+    """
+    if not regexp:
+        matches = lambda s: s
+    elif exact:
+        matches = lambda s: check_string(s, regexp, exact=True)
+    elif hilight:
+        matches = make_hilighter(regexp, hilight)
+    else:
+        search = regexp.search
+        matches = lambda s: search(s) and s
+    nick, date, text = fields or ('', '', False)
+    if text:
+        _text_matches = matches
+        def matches(s):
+            # the message starts after the second tab
+            i = s.find('\t', s.find('\t') + 1) + 1
+            if not i:
+                return _text_matches(s)
+            matched = _text_matches(s[i:])
+            if isinstance(matched, str):
+                return s[:i] + matched
+            return matched
+    prefilter = make_prefilter(regexp)
+    if prefilter:
+        _matches = matches
+        def matches(s):
+            if prefilter(s):
+                return _matches(s)
+    if invert:
+        def check(s):
+            if matches(s):
+                return None
+            else:
+                return s
+    else:
+        check = matches
+    field_regexp = make_field_regexp(nick, date)
+    if field_regexp:
+        # fields are checked first, they're cheap
+        field_match = field_regexp.match
+        _check = check
+        def check(s):
+            if field_match(s):
+                return _check(s)
+    return check
+
+def make_hilighter(regexp, hilight):
+    """
+    Returns a function that colours the matches of 'regexp' in a string with the colours in
+    'hilight' ('color,reset'), or returns None if there's no match. Colours are applied in a
+    single pass over the string, if the regexp has groups only the groups are coloured.
+    """
+    # hilight is a string and not a tuple because it's passed as is to background workers
+    color_hilight, color_reset = hilight.split(',', 1)
+    search = regexp.search
+    if regexp.groups:
+        groups = range(1, regexp.groups + 1)
+        def hilight_groups(match):
+            s = match.group()
+            offset = match.start()
+            L = []
+            pos = 0
+            for group in groups:
+                start, end = match.span(group)
+                start -= offset
+                end -= offset
+                # skip groups that didn't match, are empty or are inside a coloured group
+                if start < pos or start == end:
+                    continue
+                L.extend((s[pos:start], color_hilight, s[start:end], color_reset))
+                pos = end
+            L.append(s[pos:])
+            return ''.join(L)
+        subn = regexp.subn
+        def hilighter(s):
+            s, n = subn(hilight_groups, s)
+            if n:
+                return s
+    else:
+        # with the whole regexp as a group split() returns the text between matches and the
+        # matches, no match objects are created. Empty matches don't split, so they aren't
+        # coloured.
+        split = re.compile('(%s)' % regexp.pattern, regexp.flags).split
+        def hilighter(s):
+            L = split(s)
+            if len(L) == 1:
+                return search(s) and s
+            L[1::2] = [ color_hilight + m + color_reset for m in L[1::2] ]
+            return ''.join(L)
+    return hilighter
+
 def check_string(s, regexp, hilight='', exact=False):
-    """Checks 's' with a regexp and returns it if is a match."""
+    """Checks 's' with a regexp and returns it if is a match. For checking many strings use
+    make_check()."""
     if not regexp:
         return s
 
@@ -699,396 +1464,1996 @@ def check_string(s, regexp, hilight='', exact=False):
             return matchlist
 
     elif hilight:
-        matchlist = regexp.findall(s)
-        if matchlist:
-            if isinstance(matchlist[0], tuple):
-                # flatten matchlist
-                matchlist = [ item for L in matchlist for item in L if item ]
-            matchlist = list(set(matchlist)) # remove duplicates if any
-            # apply hilight
-            color_hilight, color_reset = hilight.split(',', 1)
-            for m in matchlist:
-                s = s.replace(m, '%s%s%s' % (color_hilight, m, color_reset))
-            return s
+        return make_hilighter(regexp, hilight)(s)
 
     # no need for findall() here
     elif regexp.search(s):
         return s
 
-def grep_file(file, head, tail, after_context, before_context, count, regexp,
-              hilight, exact, invert):
-    """Return a list of lines that match 'regexp' in 'file', if no regexp returns all lines."""
+def read_range(file_object, size):
+    """Yields the lines of 'file_object' that start in the next 'size' bytes."""
+    for line in file_object:
+        yield line
+        size -= len(line)
+        if size <= 0:
+            break
+
+PROGRESS_STEP = 1024*1024 # 1 MiB
+def report_progress(file_iter, progress):
+    """Yields the lines of 'file_iter', calling progress(bytes) each time a MiB is read."""
+    size = step = 0
+    for line in file_iter:
+        yield line
+        step += len(line)
+        if step >= PROGRESS_STEP:
+            size += step
+            step = 0
+            progress(size)
+
+REVERSE_BLOCK_SIZE = 64*1024
+def reverse_lines(file_object, start=0, end=None, block_size=REVERSE_BLOCK_SIZE):
+    """
+    Yields the lines of 'file_object' between 'start' and 'end' (or EOF) backwards, last line
+    first. The file is read from the end in blocks, so memory use doesn't depend on its size.
+    """
+    if end is None:
+        file_object.seek(0, 2)
+        end = file_object.tell()
+    pos = end
+    # carry is the start of a line whose rest was already read, nl its line terminator, only the
+    # last line of the file might lack one.
+    carry, nl = '', ''
+    while pos > start:
+        size = min(block_size, pos - start)
+        pos -= size
+        file_object.seek(pos)
+        lines = (file_object.read(size) + carry).split('\n')
+        carry = lines[0]
+        if len(lines) > 1:
+            last = lines[-1] + nl
+            if last:
+                yield last
+            for i in xrange(len(lines) - 2, 0, -1):
+                yield lines[i] + '\n'
+            nl = '\n'
+    if carry or nl:
+        yield carry + nl
+
+def grep_lines(file_iter, lines, limit, after_context, before_context, count, check):
+    """
+    Adds to 'lines' the lines from 'file_iter' that pass 'check', along with their context lines.
+    Only the last 'before_context' lines are kept around, so memory use doesn't depend on how many
+    lines 'file_iter' yields. Paragraphs of context that overlap are merged.
+    """
+    for step in grep_lines_steps(file_iter, lines, limit, after_context, before_context, count,
+                                 check):
+        pass
+    return lines
 
-    lines = linesList()
+LINES_STEP = 2000
+def grep_lines_steps(file_iter, lines, limit, after_context, before_context, count, check,
+                     step=LINES_STEP):
+    """Generator version of grep_lines(), yields after every 'step' lines read so the search can
+    be paused."""
     # define these locally as it makes the loop run slightly faster
     append = lines.append
     count_match = lines.count_match
     separator = lines.append_separator
-    if invert:
-        def check(s):
-            if check_string(s, regexp, hilight, exact):
-                return None
+    use_separator = after_context or before_context
+    context = deque(maxlen=before_context)
+    context_append = context.append
+    skipped = 0 # lines not shown since the last shown line
+    after = 0   # after context lines left to show
+    shown = False
+    file_iter = iter(file_iter)
+    while True:
+        chunk = list(islice(file_iter, step))
+        if not chunk:
+            return
+        for line in chunk:
+            matched = check(line)
+            if matched:
+                if use_separator and shown and skipped > len(context):
+                    # paragraphs don't overlap
+                    separator()
+                if context:
+                    for context_line in context:
+                        append(context_line)
+                    context.clear()
+                count or append(matched)
+                count_match(matched)
+                shown = True
+                skipped = 0
+                after = after_context
+            elif after:
+                append(line)
+                skipped = 0
+                after -= 1
             else:
-                return s
+                skipped += 1
+                if before_context:
+                    context_append(line)
+                continue
+            if limit and not after and lines.matches_count >= limit:
+                return
+        yield len(chunk)
+
+MMAP_WINDOW = 4*1024*1024 # 4 MiB
+def mmap_windows(mm, start, end, window=MMAP_WINDOW, reverse=False):
+    """Yields (start, end) offsets of windows of 'mm' of about 'window' bytes, aligned to lines."""
+    if not reverse:
+        while start < end:
+            window_end = start + window
+            if window_end >= end:
+                window_end = end
+            else:
+                window_end = mm.find('\n', window_end, end) + 1 or end
+            yield start, window_end
+            start = window_end
     else:
-        check = lambda s: check_string(s, regexp, hilight, exact)
-    
-    try:
-        file_object = open(file, 'r')
-    except IOError:
-        # file doesn't exist
-        return lines
-    if tail or before_context:
-        # for these options, I need to seek in the file, but is slower and uses a good deal of
-        # memory if the log is too big, so we do this *only* for these options.
-        file_lines = file_object.readlines()
+        while end > start:
+            window_start = end - window
+            if window_start <= start:
+                window_start = start
+            else:
+                window_start = mm.rfind('\n', start, window_start) + 1 or start
+            yield window_start, end
+            end = window_start
 
-        if tail:
-            # instead of searching in the whole file and later pick the last few lines, we
-            # reverse the log, search until count reached and reverse it again, that way is a lot
-            # faster
-            file_lines.reverse()
-            # don't invert context switches
-            before_context, after_context = after_context, before_context
-
-        if before_context:
-            before_context_range = range(1, before_context + 1)
-            before_context_range.reverse()
-
-        limit = tail or head
-
-        line_idx = 0
-        while line_idx < len(file_lines):
-            line = file_lines[line_idx]
-            line = check(line)
-            if line:
-                if before_context:
-                    separator()
-                    trimmed = False
-                    for id in before_context_range:
-                        try:
-                            context_line = file_lines[line_idx - id]
-                            if check(context_line):
-                                # match in before context, that means we appended these same lines in a
-                                # previous match, so we delete them merging both paragraphs
-                                if not trimmed:
-                                    del lines[id - before_context - 1:]
-                                    trimmed = True
-                            else:
-                                append(context_line)
-                        except IndexError:
-                            pass
-                append(line)
-                count_match(line)
-                if after_context:
-                    id, offset = 0, 0
-                    while id < after_context + offset:
-                        id += 1
-                        try:
-                            context_line = file_lines[line_idx + id]
-                            _context_line = check(context_line)
-                            if _context_line:
-                                offset = id
-                                context_line = _context_line # so match is hilighted with --hilight
-                                count_match()
-                            append(context_line)
-                        except IndexError:
-                            pass
-                    separator()
-                    line_idx += id
-                if limit and lines.matches_count >= limit:
-                    break
-            line_idx += 1
+def mmap_lines(mm, regexp, start, end):
+    """
+    Yields the lines between 'start' and 'end' where 'regexp' finds a match. The regexp runs over
+    the whole range, lines are only located around hits. 'regexp' must be compiled with
+    re.MULTILINE and lines must be checked again, as a match can span several lines.
+    """
+    search = regexp.search
+    find = mm.find
+    rfind = mm.rfind
+    pos = start
+    while pos < end:
+        m = search(mm, pos, end)
+        if not m:
+            break
+        hit = m.start()
+        if hit >= end:
+            break
+        line_start = rfind('\n', pos, hit) + 1 or pos
+        line_end = find('\n', hit, end) + 1 or end
+        yield mm[line_start:line_end]
+        pos = line_end
+
+def map_file(file_object):
+    """Returns a read only mmap of 'file_object', or None if the file can't be mapped."""
+    try:
+        return mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        # empty file, or not a regular file
+        return None
 
+def grep_mmap_steps(mm, lines, start, end, head, tail, count, regexp, check, progress=None):
+    """
+    Fast path of grep_file() for searches without context lines or --invert, only matching lines
+    are read from the log mapped in 'mm'. The regexp must not match newlines, see
+    is_line_local(). It's a generator that yields after each window.
+    """
+    if end is None or end > len(mm):
+        end = len(mm)
+    regexp = re.compile(regexp.pattern, regexp.flags | re.MULTILINE)
+    append = lines.append
+    count_match = lines.count_match
+    limit = head or tail
+    read = 0
+    for window_start, window_end in mmap_windows(mm, start, end, reverse=bool(tail)):
+        found = mmap_lines(mm, regexp, window_start, window_end)
         if tail:
-            lines.reverse()
-    else:
-        # do a normal grep
-        limit = head
-
-        for line in file_object:
+            found = reversed(list(found))
+        for line in found:
             line = check(line)
             if line:
                 count or append(line)
                 count_match(line)
-                if after_context:
-                    id, offset = 0, 0
-                    while id < after_context + offset:
-                        id += 1
-                        try:
-                            context_line = file_object.next()
-                            _context_line = check(context_line)
-                            if _context_line:
-                                offset = id
-                                context_line = _context_line
-                                count_match()
-                            count or append(context_line)
-                        except StopIteration:
-                            pass
-                    separator()
                 if limit and lines.matches_count >= limit:
-                    break
+                    return
+        if progress:
+            read += window_end - window_start
+            progress(read)
+        yield window_end - window_start
+
+def grep_lines_tail_steps(file_iter, lines, tail, after_context, before_context, check, reopen,
+                          dates=None):
+    """
+    Like grep_lines_steps() but for --tail in logs that can only be read forward. Without context
+    options only the last lines are kept, with context options the log is read twice, first for
+    count the matches, then for add the last ones with their context. 'dates' is applied to the
+    second read like filter_dates().
+    """
+    if not (after_context or before_context):
+        last_lines = boundedLinesList(tail)
+        for step in grep_lines_steps(file_iter, last_lines, 0, 0, 0, False, check):
+            yield step
+        lines.extend(last_lines[-tail:])
+        lines.matches_count += min(last_lines.matches_count, tail)
+        return
+    counter = linesList()
+    for step in grep_lines_steps(file_iter, counter, 0, 0, 0, True, check):
+        yield step
+    skip = [ max(counter.matches_count - tail, 0) ]
+    def tail_check(s):
+        matched = check(s)
+        if matched and skip[0]:
+            # match before the last ones, but might be shown as context
+            skip[0] -= 1
+            return None
+        return matched
+    file_object = reopen()
+    try:
+        file_iter = file_object
+        if dates:
+            file_iter = filter_dates(file_iter, dates)
+        for step in grep_lines_steps(file_iter, lines, 0, after_context, before_context, False,
+                                     tail_check):
+            yield step
+    finally:
+        file_object.close()
+
+COUNT_BLOCK_SIZE = 1024*1024 # 1 MiB
+def read_blocks(file_object, size=None, block_size=COUNT_BLOCK_SIZE):
+    """Yields blocks of whole lines read from 'file_object', until EOF or 'size' bytes were read.
+    The last line of the last block might lack its line terminator."""
+    carry = ''
+    read = file_object.read
+    while size is None or size > 0:
+        n = block_size
+        if size is not None:
+            n = min(n, size)
+            size -= n
+        block = read(n)
+        if not block:
+            break
+        i = block.rfind('\n') + 1
+        if i:
+            yield carry + block[:i]
+            carry = block[i:]
+        else:
+            carry += block
+    if carry:
+        yield carry
+
+def count_block(block, search, check=None):
+    """
+    Returns how many lines of 'block' have a match, 'search' is the search method of a regexp
+    compiled with re.MULTILINE. The regexp runs over the whole block and lines are only located
+    around hits, no string is made for the lines. If 'check' is given, lines with a hit are
+    counted only if they pass it.
+    """
+    n = 0
+    pos = 0
+    end = len(block)
+    find = block.find
+    rfind = block.rfind
+    while pos < end:
+        m = search(block, pos)
+        if not m:
+            break
+        hit = m.start()
+        line_end = find('\n', hit) + 1 or end
+        if check:
+            if not check(block[rfind('\n', 0, hit) + 1:line_end]):
+                pos = line_end
+                continue
+        elif m.end() > line_end and not search(block, rfind('\n', 0, hit) + 1, line_end):
+            # the match spans several lines, and there's no match in its first line alone
+            pos = line_end
+            continue
+        n += 1
+        pos = line_end
+    return n
+
+def count_file_steps(file_object, lines, start, end, regexp, invert, progress=None,
+                     check=None):
+    """
+    Counting engine for --count, adds to lines.matches_count the lines of 'file_object' between
+    'start' and 'end' (or EOF) that match 'regexp', or that don't if 'invert'. The log is read in
+    blocks of lines that are searched whole, see count_block() for 'check'. It's a generator that
+    yields after each block.
+    """
+    if start:
+        file_object.seek(start)
+    size = None
+    if end is not None:
+        size = end - start
+    if regexp:
+        search = re.compile(regexp.pattern, regexp.flags | re.MULTILINE).search
+    read = 0
+    for block in read_blocks(file_object, size):
+        total = block.count('\n')
+        if block[-1] != '\n':
+            total += 1
+        if regexp:
+            matched = count_block(block, search, check)
+        else:
+            matched = total
+        if invert:
+            matched = total - matched
+        lines.matches_count += matched
+        if progress:
+            read += len(block)
+            progress(read)
+        yield len(block)
+
+def count_lines_steps(line_iter, lines, regexp, invert, check=None, step=LINES_STEP):
+    """Like count_file_steps() for lines without line terminators, like the lines of a buffer.
+    Every 'step' lines are joined and searched as a block."""
+    if regexp:
+        search = re.compile(regexp.pattern, regexp.flags | re.MULTILINE).search
+    line_iter = iter(line_iter)
+    while True:
+        chunk = list(islice(line_iter, step))
+        if not chunk:
+            return
+        total = len(chunk)
+        if regexp:
+            matched = count_block('\n'.join(chunk), search, check)
+        else:
+            matched = total
+        if invert:
+            matched = total - matched
+        lines.matches_count += matched
+        yield total
 
-    file_object.close()
+def grep_file(file, head, tail, after_context, before_context, count, regexp,
+              hilight, exact, invert, start=0, end=None, lines=None, progress=None, fast=True,
+              dates=None, fields=None):
+    """
+    Return a list of lines that match 'regexp' in 'file', if no regexp returns all lines.
+    If 'start' or 'end' are given, only the lines starting between these offsets are searched,
+    they must be aligned to line boundaries (not supported in compressed logs, which are
+    decompressed while searching). Matches are added to 'lines' if given, and
+    'progress' is called with the amount of bytes read from time to time. If 'fast' is true,
+    searches that don't need context lines are done over a mmap of the log. If 'dates' is given,
+    a (since, until) pair, only lines dated between them are searched. 'fields' are the field
+    filters (nick, date, text), see make_check().
+    """
+    if lines is None:
+        lines = linesList()
+    for step in grep_file_steps(file, head, tail, after_context, before_context, count, regexp,
+                                hilight, exact, invert, start, end, lines, progress, fast, dates,
+                                fields):
+        pass
     return lines
 
-def grep_buffer(buffer, regexp):
-    """Return a list of lines that match 'regexp' in 'buffer', if no regexp returns all lines."""
-    lines = linesList()
+def grep_file_steps(file, head, tail, after_context, before_context, count, regexp,
+                    hilight, exact, invert, start, end, lines, progress=None, fast=True,
+                    dates=None, fields=None):
+    """Generator version of grep_file(), searches a step each time is resumed so the search can
+    be paused, see grep_lines_steps()."""
+    check = make_check(regexp, hilight, exact, invert, fields)
+    # the regexp searched over many lines at once by the fast paths, lines with a hit are checked
+    # after. Without a pattern the lines with the nick or date are searched.
+    scan = regexp or (fields and make_field_regexp(fields[0], fields[1]))
+
+    compressed = is_compressed(file)
+    if dates and not compressed:
+        date_range = get_date_range(file, dates, start, end)
+        if date_range is None:
+            return
+        start, end = date_range
+    try:
+        file_object = open_log(file)
+    except IOError:
+        # file doesn't exist
+        return
+    try:
+        # with --count only the number of matching lines is needed, no line is kept. Compressed
+        # logs must be filtered by date line by line, and patterns that can match a newline
+        # searched line by line. Inverted counts can't be done with field filters, these aren't
+        # inverted.
+        count_only = count and not exact and not (compressed and dates) \
+                and (not scan or is_line_local(scan)) and not (fields and invert)
+        mm = None
+        if fast and scan and is_line_local(scan) \
+                and not (count_only or compressed or invert or after_context or before_context):
+            mm = map_file(file_object)
+        if count_only:
+            for step in count_file_steps(file_object, lines, start, end, scan, invert, progress,
+                                         fields and check):
+                yield step
+        elif mm is not None:
+            try:
+                steps = grep_mmap_steps(mm, lines, start, end, head, tail, count, scan, check,
+                                        progress)
+                for step in steps:
+                    yield step
+            finally:
+                mm.close()
+        elif compressed:
+            # can't seek in compressed logs, they're always read forward and completely
+            file_iter = file_object
+            if progress:
+                file_iter = report_progress(file_iter, progress)
+            if dates:
+                file_iter = filter_dates(file_iter, dates)
+            if tail:
+                steps = grep_lines_tail_steps(file_iter, lines, tail, after_context,
+                                              before_context, check, lambda: open_log(file),
+                                              dates)
+            else:
+                steps = grep_lines_steps(file_iter, lines, head, after_context, before_context,
+                                         count, check)
+            for step in steps:
+                yield step
+        else:
+            if tail:
+                # instead of searching in the whole file and later pick the last few lines, we
+                # read the log backwards, search until count reached and reverse the result, that
+                # way is a lot faster
+                file_iter = reverse_lines(file_object, start, end)
+                # don't invert context switches
+                before_context, after_context = after_context, before_context
+            else:
+                file_iter = file_object
+                if start:
+                    file_object.seek(start)
+                if end is not None:
+                    file_iter = read_range(file_object, end - start)
+            if progress:
+                file_iter = report_progress(file_iter, progress)
+            for step in grep_lines_steps(file_iter, lines, tail or head, after_context,
+                                         before_context, count, check):
+                yield step
+    finally:
+        file_object.close()
+    if tail and not compressed:
+        lines.reverse()
 
+def grep_buffer_steps(buffer, regexp, lines):
+    """
+    Adds to 'lines' the lines that match 'regexp' in 'buffer', if no regexp adds all lines. It's a
+    generator that searches a step each time is resumed, see grep_lines_steps().
+    """
     # Using /grep in grep's buffer can lead to some funny effects
     # We should take measures if that's the case
-    def make_get_line_funcion():
-        """Returns a function for get lines from the infolist, depending if the buffer is grep's or
-        not."""
-        string_remove_color = weechat.string_remove_color
-        infolist_string = weechat.infolist_string
-        grep_buffer = weechat.buffer_search('python', SCRIPT_NAME)
-        if grep_buffer and buffer == grep_buffer:
-            def function(infolist):
-                tags = infolist_string(infolist, 'tags')
-                if 'grep' in tags:
-                    return None
-                prefix = infolist_string(infolist, 'prefix')
-                message = infolist_string(infolist, 'message')
-                if prefix: # only our messages have prefix, ignore it
-                    return None
-                return message
-        else:
-            infolist_time = weechat.infolist_time
-            def function(infolist):
-                tags = infolist_string(infolist, 'tags')
-                if 'grep' in tags:
-                    return None
-                prefix = string_remove_color(infolist_string(infolist, 'prefix'), '')
-                message = string_remove_color(infolist_string(infolist, 'message'), '')
-                date = infolist_time(infolist, 'date')
-                return '%s\t%s\t%s' %(date, prefix, message)
-        return function
-    get_line = make_get_line_funcion()
-
-    infolist = weechat.infolist_get('buffer_lines', buffer, '')
-    if options.tail:
-        # like with grep_file() if we need the last few matching lines, we move the cursor to
-        # the end and search backwards
-        infolist_next = weechat.infolist_prev
-        infolist_prev = weechat.infolist_next
+    grep_buffer = weechat.buffer_search('python', SCRIPT_NAME)
+    if grep_buffer and buffer == grep_buffer:
+        buffer_lines = get_grep_buffer_lines(buffer)
     else:
-        infolist_next = weechat.infolist_next
-        infolist_prev = weechat.infolist_prev
-    limit = options.head or options.tail
+        # a copy, the cache changes if something is printed in the buffer
+        buffer_lines = list(get_buffer_lines(buffer))
 
-    # define these locally as it makes the loop run slightly faster
-    append = lines.append
-    count_match = lines.count_match
-    separator = lines.append_separator
-    if options.invert:
-        def check(s):
-            if check_string(s, regexp, options.hilight, options.exact):
-                return None
-            else:
-                return s
+    fields = options.fields
+    check = make_check(regexp, options.hilight, options.exact, options.invert, fields)
+    after_context, before_context = options.after_context, options.before_context
+    if options.tail:
+        # like with grep_file() if we need the last few matching lines, we search backwards
+        line_iter = reversed(buffer_lines)
+        before_context, after_context = after_context, before_context
     else:
-        check = lambda s: check_string(s, regexp, options.hilight, options.exact)
-
-    if options.before_context:
-        before_context_range = range(1, options.before_context + 1)
-        before_context_range.reverse()
-
-    while infolist_next(infolist):
-        line = get_line(infolist)
-        if line is None: continue
-        line = check(line)
-        if line:
-            if options.before_context:
-                separator()
-                trimmed = False
-                for id in before_context_range:
-                    if not infolist_prev(infolist):
-                        trimmed = True
-                for id in before_context_range:
-                    context_line = get_line(infolist)
-                    if check(context_line):
-                        if not trimmed:
-                            del lines[id - before_context - 1:]
-                            trimmed = True
-                    else:
-                        append(context_line)
-                    infolist_next(infolist)
-            options.count or append(line)
-            count_match(line)
-            if options.after_context:
-                id, offset = 0, 0
-                while id < options.after_context + offset:
-                    id += 1
-                    if infolist_next(infolist):
-                        context_line = get_line(infolist)
-                        _context_line = check(context_line)
-                        if _context_line:
-                            context_line = _context_line
-                            offset = id
-                            count_match()
-                        append(context_line)
-                    else:
-                        # in the main loop infolist_next will start again an cause an infinite loop
-                        # this will avoid it
-                        infolist_next = lambda x: 0
-                separator()
-            if limit and lines.matches_count >= limit:
-                break
-    weechat.infolist_free(infolist)
-
+        line_iter = iter(buffer_lines)
+    dates = options.dates
+    if dates:
+        line_iter = ( line for line in line_iter if in_dates(line, dates) )
+    scan = regexp or (fields and make_field_regexp(fields[0], fields[1]))
+    if options.count and not options.exact and (not scan or is_line_local(scan)) \
+            and not (fields and options.invert):
+        # only the number of matching lines is needed, no line is kept
+        for step in count_lines_steps(line_iter, lines, scan, options.invert,
+                                      fields and check):
+            yield step
+        return
+    for step in grep_lines_steps(line_iter, lines, options.tail or options.head, after_context,
+                                 before_context, options.count, check):
+        yield step
     if options.tail:
         lines.reverse()
-    return lines
 
-### this is our main grep function
-hook_file_grep = None
-def show_matching_lines():
-    """
-    Greps buffers in search_in_buffers or files in search_in_files and updates grep buffer with the
-    result.
-    """
-    global search_in_files, search_in_buffers, matched_lines
-    global time_start
-    matched_lines = linesDict()
-    #debug('buffers:%s \nlogs:%s' %(search_in_buffers, search_in_files))
+### Buffer lines ###
+# Lines of the buffers searched are kept without colors and formatted like in logs, so searching
+# a buffer again doesn't need its infolist. New lines are added by a print hook, and only the
+# last lines that fit in a buffer are kept.
+buffer_lines_cache = {} # buffer pointer -> deque of lines
+
+def get_history_size():
+    size = weechat.config_integer(weechat.config_get('weechat.history.max_buffer_lines_number'))
+    return size or None
+
+def get_buffer_lines(buffer):
+    """Returns the lines of 'buffer', read from its infolist only the first time."""
+    try:
+        return buffer_lines_cache[buffer]
+    except KeyError:
+        pass
+    buffer_lines = deque(maxlen=get_history_size())
+    append = buffer_lines.append
+    infolist_string = weechat.infolist_string
+    infolist_time = weechat.infolist_time
+    infolist_next = weechat.infolist_next
+    string_remove_color = weechat.string_remove_color
+    infolist = weechat.infolist_get('buffer_lines', buffer, '')
+    try:
+        while infolist_next(infolist):
+            tags = infolist_string(infolist, 'tags')
+            if 'grep' in tags:
+                continue
+            prefix = string_remove_color(infolist_string(infolist, 'prefix'), '')
+            message = string_remove_color(infolist_string(infolist, 'message'), '')
+            date = infolist_time(infolist, 'date')
+            append('%s\t%s\t%s' %(date, prefix, message))
+    finally:
+        weechat.infolist_free(infolist)
+    buffer_lines_cache[buffer] = buffer_lines
+    return buffer_lines
+
+def get_grep_buffer_lines(buffer):
+    """Returns the lines printed by a search in grep's buffer, these aren't cached."""
+    buffer_lines = []
+    infolist_string = weechat.infolist_string
+    infolist = weechat.infolist_get('buffer_lines', buffer, '')
+    try:
+        while weechat.infolist_next(infolist):
+            tags = infolist_string(infolist, 'tags')
+            if 'grep' in tags:
+                continue
+            prefix = infolist_string(infolist, 'prefix')
+            if prefix: # only our messages have prefix, ignore it
+                continue
+            buffer_lines.append(infolist_string(infolist, 'message'))
+    finally:
+        weechat.infolist_free(infolist)
+    return buffer_lines
+
+def buffer_print_cb(data, buffer, date, tags, displayed, highlight, prefix, message):
+    """Adds printed lines to the cache of their buffer, colors are already stripped."""
+    try:
+        buffer_lines = buffer_lines_cache[buffer]
+    except KeyError:
+        return WEECHAT_RC_OK
+    if 'grep' not in tags:
+        date = time.strftime(DATE_FORMAT, time.localtime(int(date)))
+        buffer_lines.append('%s\t%s\t%s' %(date, prefix, message))
+    return WEECHAT_RC_OK
+
+def buffer_cleared_cb(data, signal, buffer):
+    """Buffer was cleared or closed, forget its lines."""
+    if buffer in buffer_lines_cache:
+        del buffer_lines_cache[buffer]
+    return WEECHAT_RC_OK
+
+### Date ranges ###
+# WeeChat logs (and buffer lines) start with a date that sorts as a string, so a log can be
+# bisected by byte offset for finding where a date starts.
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_LEN = 19
+_logDateRe = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d')
+_dateRe = re.compile(r'^(\d{4})-(\d\d)-(\d\d)(?:[Tt_](\d\d):(\d\d)(?::(\d\d))?)?$')
+_timeRe = re.compile(r'^(\d\d?):(\d\d)(?::(\d\d))?$')
+_relativeDateRe = re.compile(r'^(\d+)([mhdw])$')
+_dateUnits = { 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800 }
+
+def day_start(t, days=0):
+    """Returns the time of the midnight that starts the day of 't', 'days' days later."""
+    year, month, day = time.localtime(t)[:3]
+    return time.mktime((year, month, day + days, 0, 0, 0, 0, 0, -1))
+
+def parse_date(s, until=False):
+    """
+    Converts the argument of --since or --until into a date like the ones in logs. Accepts
+    'YYYY-MM-DD[THH:MM[:SS]]', 'HH:MM[:SS]' (today), 'today', 'yesterday' or time ago like '30m',
+    '2h', '3d' or '1w'. If 'until' is true, dates without time include the whole day.
+    """
+    t = time.time()
+    m = _relativeDateRe.match(s)
+    if m:
+        n, unit = m.groups()
+        return time.strftime(DATE_FORMAT, time.localtime(t - int(n) * _dateUnits[unit]))
+    if s.lower() in ('today', 'yesterday'):
+        days = s.lower() == 'yesterday' and -1 or 0
+        if until:
+            days += 1
+        return time.strftime(DATE_FORMAT, time.localtime(day_start(t, days)))
+    m = _timeRe.match(s)
+    if m:
+        hour, minute, second = m.groups()
+        date = '%s %02d:%s:%s' % (time.strftime('%Y-%m-%d'), int(hour), minute, second or '00')
+    else:
+        m = _dateRe.match(s)
+        if not m:
+            raise ValueError, "%s isn't a valid date." % s
+        year, month, day, hour, minute, second = m.groups()
+        date = '%s-%s-%s %s:%s:%s' % (year, month, day, hour or '00', minute or '00',
+                                      second or '00')
+    try:
+        t = time.mktime(time.strptime(date, DATE_FORMAT))
+    except ValueError:
+        raise ValueError, "%s isn't a valid date." % s
+    if until and hour is None:
+        # the whole day
+        date = time.strftime(DATE_FORMAT, time.localtime(day_start(t, 1)))
+    return date
+
+def in_dates(line, dates):
+    """Checks if 'line' is dated between the (since, until) pair 'dates', lines without date are
+    always in range."""
+    if not _logDateRe.match(line):
+        return True
+    since, until = dates
+    date = line[:DATE_LEN]
+    return (not since or date >= since) and (not until or date < until)
+
+def filter_dates(file_iter, dates):
+    """Yields the lines of 'file_iter' dated between 'dates', lines must be sorted by date. If the
+    first line isn't dated all lines are yielded, otherwise undated lines before 'since' are
+    skipped and the ones after it are yielded until a line dated at or after 'until'."""
+    since, until = dates
+    first = True
+    for line in file_iter:
+        if not _logDateRe.match(line):
+            if first:
+                yield line
+                for line in file_iter:
+                    yield line
+                return
+            continue
+        first = False
+        if not since or line[:DATE_LEN] >= since:
+            break
+    else:
+        return
+    n = DATE_LEN
+    if not until or line[:n] < until:
+        yield line
+        for line in file_iter:
+            if until and line[:n] >= until and _logDateRe.match(line):
+                break
+            yield line
+
+def bisect_log(file_object, date, start, end):
+    """Returns the offset of the first line starting between offsets 'start' and 'end' dated at or
+    after 'date', or 'end' if there's none. 'start' must be aligned to a line boundary."""
+    def line_start(offset):
+        # first line starting at or after offset
+        if offset == start:
+            return offset
+        file_object.seek(offset - 1)
+        file_object.readline()
+        return file_object.tell()
+
+    lo, hi = start, end
+    while lo < hi:
+        mid = (lo + hi) // 2
+        offset = line_start(mid)
+        if offset >= end:
+            hi = mid
+            continue
+        file_object.seek(offset)
+        if file_object.readline()[:DATE_LEN] < date:
+            lo = offset + 1
+        else:
+            hi = mid
+    return min(line_start(lo), end)
+
+def get_date_range(file, dates, start=0, end=None):
+    """
+    Returns the offsets (start, end) of the lines of 'file' dated between the (since, until) pair
+    'dates', within 'start' and 'end' if given. Returns None if no line is in range. Logs that
+    aren't dated or are compressed are searched whole, so for these the offsets are unchanged.
+    """
+    since, until = dates
+    if is_compressed(file):
+        return start, end
+    try:
+        file_object = open(file, 'rb')
+    except IOError:
+        return None
+    try:
+        file_object.seek(start)
+        first = file_object.readline()
+        if not _logDateRe.match(first):
+            return start, end
+        if end is None:
+            file_object.seek(0, 2)
+            size = file_object.tell()
+        else:
+            size = end
+        # date of the last dated line, logs might end with empty or undated lines
+        last = ''
+        for line in reverse_lines(file_object, start, size):
+            if _logDateRe.match(line):
+                last = line
+                break
+        if (until and first[:DATE_LEN] >= until) or (since and last[:DATE_LEN] < since):
+            return None
+        if since:
+            start = bisect_log(file_object, since, start, size)
+        if until:
+            offset = bisect_log(file_object, until, start, size)
+            if offset < size:
+                # otherwise keep reading until EOF, the log might have grown
+                end = offset
+        if start == (end is None and size or end):
+            return None
+        return start, end
+    finally:
+        file_object.close()
+
+### Log index ###
+_indexWordRe = re.compile(r'\w+')
+_indexMetaKey = '\x00meta'
+# nicks are kept as terms with this prefix, words never have it
+_indexNickPrefix = '\x01'
+INDEX_VERSION = 2
+# terms found in more than this fraction of the lines of a log aren't worth indexing
+INDEX_COMMON_RATIO = 0.25
+INDEX_FLUSH_SIZE = 1 << 21
+
+def get_index_dir():
+    return path.join(weechat.info_get('weechat_dir', ''), 'grep_index')
+
+def index_query(pattern):
+    """
+    Returns the words a line must contain for match 'pattern', or None if the pattern isn't a
+    plain literal or word pattern (in which case the index can't answer it).
+    Each word is a tuple (word, open_left, open_right), an open side means the word can be part
+    of a longer term in that side.
+    """
+    if not pattern:
+        return None
+    left_bound = right_bound = False
+    if pattern[:2] == r'\b':
+        pattern = pattern[2:]
+        left_bound = True
+    if pattern[-2:] == r'\b' and pattern[-3:-2] != '\\':
+        pattern = pattern[:-2]
+        right_bound = True
+    literal = ''
+    escaped = False
+    for c in pattern:
+        if escaped:
+            if c.isalnum():
+                # \d \w \s and friends, not a literal
+                return None
+            literal += c
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c in '.^$*+?{}[]|()':
+            return None
+        else:
+            literal += c
+    if escaped or not literal:
+        return None
+    words = _indexWordRe.findall(literal.lower())
+    if not words:
+        return None
+    is_word = lambda c: _indexWordRe.match(c) is not None
+    left_open = not left_bound and is_word(literal[0])
+    right_open = not right_bound and is_word(literal[-1])
+    last = len(words) - 1
+    return [ (w, i == 0 and left_open, i == last and right_open) for i, w in enumerate(words) ]
+
+class LogIndex(object):
+    """
+    On-disk inverted index of a log file, maps lowercased words to the offsets of the lines
+    containing them. The index is updated incrementally from the last indexed offset, terms too
+    common for being useful are dropped and only remembered as such. The nick of each line is
+    indexed apart, nicks are never dropped.
+    """
+    def __init__(self, log, index_dir):
+        self.log = log
+        self.index_dir = index_dir
+        self.filename = path.join(index_dir, md5(log).hexdigest())
+        self.db = None
+
+    def exists(self):
+        return bool(glob(self.filename + '*'))
+
+    def remove(self):
+        self.close()
+        for f in glob(self.filename + '*'):
+            os.remove(f)
+
+    def open(self, flag='c'):
+        if self.db is None:
+            self.db = shelve.open(self.filename, flag, protocol=2)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def _meta(self):
+        return self.db[_indexMetaKey]
+
+    def _postings(self, term):
+        L = array('L')
+        L.fromstring(self.db[term])
+        return L
+
+    def build(self):
+        """Indexes the whole log, discarding any previous index."""
+        self.remove()
+        if not path.isdir(self.index_dir):
+            os.makedirs(self.index_dir)
+        db = self.open('n')
+        try:
+            meta = { 'version': INDEX_VERSION,
+                     'log': self.log,
+                     'inode': os.stat(self.log).st_ino,
+                     'offset': 0,
+                     'lines': 0,
+                     'common': set() }
+            self._index(meta)
+            # prune common terms
+            lines = meta['lines']
+            if lines * INDEX_COMMON_RATIO > 100:
+                max_postings = int(lines * INDEX_COMMON_RATIO) * array('L').itemsize
+                for term in db.keys():
+                    if term[0] not in (_indexMetaKey[0], _indexNickPrefix) \
+                            and len(db[term]) > max_postings:
+                        del db[term]
+                        meta['common'].add(term)
+            db[_indexMetaKey] = meta
+        finally:
+            self.close()
+
+    def update(self):
+        """
+        Indexes lines appended to the log since the last update. Returns False if the index is
+        stale (the log was rotated or truncated) and can't be used.
+        """
+        db = self.open()
+        try:
+            meta = self._meta()
+        except KeyError:
+            return False
+        try:
+            st = os.stat(self.log)
+        except OSError:
+            return False
+        if meta.get('version') != INDEX_VERSION or st.st_ino != meta['inode'] \
+                or st.st_size < meta['offset']:
+            return False
+        if st.st_size > meta['offset']:
+            self._index(meta)
+            db[_indexMetaKey] = meta
+        return True
+
+    def _index(self, meta):
+        """Indexes the log from meta['offset'], only complete lines are indexed."""
+        db = self.db
+        common = meta['common']
+        pending = {}
+        pending_size = [0]
+        def flush():
+            for term, postings in pending.iteritems():
+                if term in db:
+                    db[term] = db[term] + postings.tostring()
+                else:
+                    db[term] = postings.tostring()
+            pending.clear()
+            pending_size[0] = 0
+
+        offset = meta['offset']
+        lines = meta['lines']
+        findall = _indexWordRe.findall
+        fd = open(self.log, 'rb')
+        try:
+            fd.seek(offset)
+            for line in fd:
+                if line[-1:] != '\n':
+                    # incomplete line, it will be indexed in the next update
+                    break
+                terms = set(findall(line.lower()))
+                i = line.find('\t') + 1
+                j = line.find('\t', i)
+                if i and j > i:
+                    terms.add(_indexNickPrefix + line[i:j].lstrip(NICK_MODES).lower())
+                for term in terms:
+                    if term in common:
+                        continue
+                    try:
+                        pending[term].append(offset)
+                    except KeyError:
+                        pending[term] = array('L', (offset, ))
+                    pending_size[0] += 1
+                offset += len(line)
+                lines += 1
+                if pending_size[0] > INDEX_FLUSH_SIZE:
+                    flush()
+        finally:
+            fd.close()
+        flush()
+        meta['offset'] = offset
+        meta['lines'] = lines
+
+    def lookup(self, words, nick=''):
+        """
+        Returns the sorted offsets of the lines that might contain 'words' (as returned by
+        index_query()) and were said by a nick matching the mask 'nick', or None if the index
+        can't answer it.
+        """
+        db = self.open()
+        common = self._meta()['common']
+        terms = None
+        candidates = None
+        if nick:
+            candidates = self.lookup_nick(nick)
+        for word, open_left, open_right in words or ():
+            if not (open_left or open_right):
+                # whole word, no need to look at the other terms
+                if word in common:
+                    continue
+                try:
+                    offsets = set(self._postings(word))
+                except KeyError:
+                    offsets = set()
+            else:
+                if open_left and open_right:
+                    match = lambda t: word in t
+                elif open_left:
+                    match = lambda t: t.endswith(word)
+                else:
+                    match = lambda t: t.startswith(word)
+                if [ t for t in common if match(t) ]:
+                    # can't know which lines have this word
+                    continue
+                if terms is None:
+                    terms = [ k for k in db.keys()
+                              if k[0] not in (_indexMetaKey[0], _indexNickPrefix) ]
+                offsets = set()
+                for term in terms:
+                    if match(term):
+                        offsets.update(self._postings(term))
+            if candidates is None:
+                candidates = offsets
+            else:
+                candidates &= offsets
+            if not candidates:
+                break
+        if candidates is None:
+            return None
+        candidates = list(candidates)
+        candidates.sort()
+        return candidates
+
+    def lookup_nick(self, nick):
+        """Returns the set of offsets of the lines said by nicks matching the mask 'nick'."""
+        db = self.open()
+        nick = nick.lstrip(NICK_MODES).lower()
+        if '*' in nick or '?' in nick:
+            match = re.compile(mask_to_regexp(nick) + '$').match
+            keys = [ k for k in db.keys() if k[0] == _indexNickPrefix and match(k[1:]) ]
+        else:
+            keys = [ _indexNickPrefix + nick ]
+        offsets = set()
+        for key in keys:
+            if key in db:
+                offsets.update(self._postings(key))
+        return offsets
+
+def grep_offsets(file, offsets, head, tail, count, regexp, hilight, exact, lines=None,
+                 invert=False, fields=None):
+    """Like grep_file(), but only checks the lines starting at 'offsets'."""
+    if lines is None:
+        lines = linesList()
+    append = lines.append
+    count_match = lines.count_match
+    limit = head or tail
+    check = make_check(regexp, hilight, exact, invert, fields)
+    if tail:
+        offsets = reversed(offsets)
+    try:
+        file_object = open(file, 'r')
+    except IOError:
+        return lines
+    try:
+        for offset in offsets:
+            file_object.seek(offset)
+            line = check(file_object.readline())
+            if line:
+                count or append(line)
+                count_match(line)
+                if limit and lines.matches_count >= limit:
+                    break
+    finally:
+        file_object.close()
+    if tail:
+        lines.reverse()
+    return lines
+
+def grep_indexed_files(files, ranges):
+    """
+    Greps the logs in 'files' that have an usable index, results are stored in matched_lines.
+    'ranges' has the offsets (start, end) of the lines to search of each log. Returns the logs
+    that must be searched normally.
+    """
+    words = None
+    if not options.invert:
+        words = index_query(options.pattern)
+    # nicks are always in the index, inverted patterns are checked in the lines said by the nick
+    nick = options.nick
+    if not (words or nick) or options.after_context or options.before_context:
+        return files
+    regexp = make_regexp(options.pattern, options.matchcase)
+    index_dir = get_index_dir()
+    remaining = []
+    stale = []
+    for log in files:
+        if is_compressed(log):
+            remaining.append(log)
+            continue
+        index = LogIndex(log, index_dir)
+        offsets = None
+        try:
+            if index.exists():
+                if index.update():
+                    offsets = index.lookup(words, nick)
+                else:
+                    # old version, rotated or truncated log, is built again below
+                    debug('index of %s is stale, rebuilding.', log)
+                    index.remove()
+                    stale.append(log)
+        except Exception, e:
+            error("Index of '%s' is broken (%s), use --reindex" % (strip_home(log), e))
+        index.close()
+        if offsets is None:
+            remaining.append(log)
+        else:
+            if log in ranges:
+                start, end = ranges[log]
+                offsets = [ offset for offset in offsets
+                                   if start <= offset and (end is None or offset < end) ]
+            log_name = strip_home(log)
+            matched_lines[log_name] = grep_offsets(log, offsets, options.head,
+                                                   options.tail,
+                                                   options.count,
+                                                   regexp,
+                                                   options.hilight,
+                                                   options.exact,
+                                                   make_lines(log_name),
+                                                   options.invert,
+                                                   options.fields)
+    if stale and not hook_index_process:
+        reindex_logs(stale, display=False)
+    return remaining
+
+hook_index_process = None
+def reindex_logs(files, display=True):
+    """
+    Rebuilds the index of 'files' in a background process. With 'display' false it's an
+    automatic rebuild, that doesn't switch to grep's buffer.
+    """
+    global hook_index_process
+    if hook_index_process:
+        error('Logs are being indexed already.')
+        return
+    files = [ log for log in files if not is_compressed(log) ]
+    if not files:
+        error("Compressed logs can't be indexed.")
+        return
+    cmd = make_process_cmd('index', logs=files, index_dir=get_index_dir())
+    debug(cmd)
+    timeout = 1000*60*60 # 1 hour
+    hook_index_process = weechat.hook_process(cmd, timeout, 'reindex_logs_callback', str(len(files)))
+    if hook_index_process:
+        size = human_readable_size(sum(map(get_size, files)))
+        print_line('Indexing %s logs (%s)...' % (len(files), size), display=display)
+
+index_stderr = ''
+def reindex_logs_callback(data, command, rc, stdout, stderr):
+    global hook_index_process, index_stderr
+    if stderr:
+        index_stderr += stderr
+    if int(rc) >= 0:
+        try:
+            if index_stderr:
+                error(index_stderr)
+            print_line('Indexing of %s logs finished.' % data)
+        finally:
+            index_stderr = ''
+            hook_index_process = None
+    return WEECHAT_RC_OK
+
+### Result cache ###
+# Results of searches in logs are kept between searches, so a search repeated (like from grep
+# buffer's input) doesn't read again the logs that didn't change, and in logs that only grew since,
+# like the ones of the channels WeeChat is in, only the new lines are searched.
+class resultCache(OrderedDict):
+    """
+    Results of the last searches in logs, the least recently used first. Keys are from
+    make_cache_key(), values are (state, lines), 'state' is get_log_state() of the log when it was
+    searched and 'lines' its linesList, or None if it had nothing to search.
+    """
+    def __init__(self):
+        OrderedDict.__init__(self)
+        self.lines = 0 # lines kept, each result counts as one line at least
+
+    def weight(self, lines):
+        return (lines and len(lines) or 0) + 1
+
+    def lookup(self, key):
+        """Returns the (state, lines) of 'key' or None, linesList isn't a copy."""
+        try:
+            value = OrderedDict.pop(self, key)
+        except KeyError:
+            return None
+        self[key] = value
+        return value
+
+    def discard(self, key):
+        value = OrderedDict.pop(self, key, None)
+        if value is not None:
+            self.lines -= self.weight(value[1])
+
+    def store(self, key, state, lines, size):
+        """Keeps 'lines' of 'key', and forgets the least recently used results until there're
+        about 'size' lines kept."""
+        self.discard(key)
+        weight = self.weight(lines)
+        if weight > size:
+            return
+        self[key] = state, lines
+        self.lines += weight
+        while self.lines > size:
+            key, (state, lines) = self.popitem(last=False)
+            self.lines -= self.weight(lines)
+
+result_cache = resultCache()
+search_cache = {} # log -> (key, state, cached lines) of the logs being searched
+
+def get_log_state(log):
+    """
+    Returns (inode, size, mtime) of 'log', for knowing if it changed since a search. Returns None if
+    it can't be read or its last line isn't complete yet.
+    """
+    try:
+        st = os.stat(log)
+        if st.st_size and not is_compressed(log):
+            fd = open(log, 'rb')
+            try:
+                fd.seek(st.st_size - 1)
+                if fd.read(1) != '\n':
+                    return None
+            finally:
+                fd.close()
+    except (OSError, IOError):
+        return None
+    return st.st_ino, st.st_size, st.st_mtime
+
+def make_cache_key(log):
+    """Key of the results of 'log' in result_cache, with every option that changes them."""
+    return (log, options.pattern, options.matchcase, options.count, options.exact,
+            options.hilight, options.invert, options.head, options.tail, options.after_context,
+            options.before_context, options.since, options.until, options.fields,
+            get_config_int('max_lines'))
+
+def use_result_cache(files, ranges):
+    """
+    Looks up in result_cache the results of 'files'. Logs that didn't change aren't searched, their
+    results go to matched_lines right away, logs that grew are only searched after the offset where
+    the last search ended. 'ranges' is updated with the part to search of each log, so results are
+    for the state the log had now. Returns the logs to search.
+    """
+    size = get_config_int('cache_size')
+    if size <= 0 or spill_file:
+        # results would be incomplete without the lines in spill file
+        return files
+    # with context or a limit results can't be joined with the ones of the new lines
+    grows = not (options.head or options.tail or options.after_context
+                 or options.before_context)
+    L = []
+    for log in files:
+        state = get_log_state(log)
+        if state is None:
+            L.append(log)
+            continue
+        key = make_cache_key(log)
+        cached = None
+        if not options.no_cache:
+            cached = result_cache.lookup(key)
+        end = state[1]
+        if cached:
+            cached_state, lines = cached
+            if cached_state == state:
+                if lines is not None:
+                    matched_lines[strip_home(log)] = lines.copy()
+                continue
+            inode, start = cached_state[:2]
+            if grows and inode == state[0] and start < end and not is_compressed(log):
+                # only new lines, the log is appended
+                ranges[log] = start, end
+                search_cache[log] = key, state, lines
+                L.append(log)
+                continue
+        if not is_compressed(log):
+            ranges[log] = 0, end
+        search_cache[log] = key, state, None
+        L.append(log)
+    return L
+
+def cache_results(results):
+    """
+    Keeps in result_cache the results of the logs in search_cache, 'results' are the lines found by
+    log name. Logs that grew get their cached lines joined with the new ones in matched_lines.
+    """
+    global search_cache
+    size = get_config_int('cache_size')
+    for log, (key, state, cached) in search_cache.iteritems():
+        log_name = strip_home(log)
+        lines = results.get(log_name)
+        if cached is not None:
+            if lines is None:
+                lines = cached
+            else:
+                joined = make_lines(log_name)
+                for L in (cached, lines):
+                    joined.extend(L)
+                    joined.matches_count += L.matches_count
+                    joined.stripped_lines += L.stripped_lines
+                lines = joined
+            dict.__setitem__(matched_lines, log_name, lines.copy())
+        elif lines is not None:
+            lines = lines.copy()
+        result_cache.store(key, state, lines, size)
+    search_cache = {}
+
+### this is our main grep function
+def show_matching_lines():
+    """
+    Greps buffers in search_in_buffers or files in search_in_files and updates grep buffer with the
+    result.
+    """
+    global search_in_files, search_in_buffers, matched_lines
+    global time_start, spill_file, search_cache
+    # results of the last search still being printed would get mixed
+    stop_render()
+    matched_lines = linesDict()
+    search_cache = {}
+    #debug('buffers:%s \nlogs:%s' %(search_in_buffers, search_in_files))
     time_start = now()
+    if spill_file:
+        spill_file.close()
+        spill_file = None
+    if get_config_boolean('spill_to_disk') and not options.count:
+        spill_file = spillFile()
 
     # buffers
     if search_in_buffers:
         regexp = make_regexp(options.pattern, options.matchcase) # XXX move in GrepOptions
+        search = ForegroundGrep('%s buffers' % len(search_in_buffers))
         for buffer in search_in_buffers:
             buffer_name = weechat.buffer_get_string(buffer, 'full_name')
-            matched_lines[buffer_name] = grep_buffer(buffer, regexp)
+            lines = make_lines(buffer_name)
+            lines.buffer = buffer
+            matched_lines[buffer_name] = lines
+            search.add(grep_buffer_steps(buffer, regexp, lines))
+        # searched in slices from a timer, many buffers with long history would block WeeChat
+        start_foreground_grep(search)
+        return
 
     # logs
-    if search_in_files:
+    files = search_in_files
+    ranges = {}
+    if files:
+        files = use_result_cache(files, ranges)
+    dates = options.dates
+    if files and dates:
+        # skip logs without lines in the time range, in the others search only the lines in range
+        L = []
+        for log in files:
+            start, end = ranges.get(log, (0, None))
+            date_range = get_date_range(log, dates, start, end)
+            if date_range is not None:
+                L.append(log)
+                if date_range != (0, None):
+                    ranges[log] = date_range
+        files = L
+    if files and get_config_boolean('index_logs'):
+        # logs with an index are searched right away, any other goes below
+        files = grep_indexed_files(files, ranges)
+    if files:
         size_limit = get_config_int('size_limit', allow_empty_string=True)
         background = False
+        size = sum([ get_range_size(log, ranges) for log in files ])
         if size_limit or size_limit == 0:
-            size = sum(map(get_size, search_in_files))
             if size > size_limit * 1024:
                 background = True
-        elif size_limit == '':
-            background = False
 
         if not background:
-            # run grep normally
+            # run grep in WeeChat's process, in slices from a timer so it can be stopped
             regexp = make_regexp(options.pattern, options.matchcase)
-            for log in search_in_files:
+            fast = get_config_boolean('use_mmap')
+            where = len(files) == 1 and strip_home(files[0]) or '%s logs' % len(files)
+            search = ForegroundGrep(where, size)
+            for log in files:
                 log_name = strip_home(log)
-                matched_lines[log_name] = grep_file(log, options.head, 
-                                                    options.tail, 
-                                                    options.after_context,
-                                                    options.before_context,
-                                                    options.count, 
-                                                    regexp, 
-                                                    options.hilight, 
-                                                    options.exact, 
-                                                    options.invert)
-            buffer_update()
+                lines = make_lines(log_name)
+                matched_lines[log_name] = lines
+                start, end = ranges.get(log, (0, None))
+                search.add(grep_file_steps(log, options.head,
+                                           options.tail,
+                                           options.after_context,
+                                           options.before_context,
+                                           options.count,
+                                           regexp,
+                                           options.hilight,
+                                           options.exact,
+                                           options.invert,
+                                           start, end, lines,
+                                           search.make_progress(log),
+                                           fast, dates, options.fields))
+            start_foreground_grep(search)
         else:
-            # we hook a process so grepping runs in background.
+            # we hook processes so grepping runs in background.
             #debug('on background')
-            global hook_file_grep, script_path, bytecode
-            timeout = 1000*60*5 # 5 min
-
-            quotify = lambda s: '"%s"' %s
-            files_string = ', '.join(map(quotify, search_in_files))
-
-            global tmpFile
-            # we keep the file descriptor as a global var so it isn't deleted until next grep
-            tmpFile = tempfile.NamedTemporaryFile(prefix=SCRIPT_NAME,
-                    dir=weechat.info_get('weechat_dir', ''))
-            args = dict(logs=files_string,
-                        home_dir=get_home(),
-                        script_path=script_path,
-                        bytecode=bytecode,
-                        filename=tmpFile.name,
-                        python=weechat.info_get('python2_bin', '') or 'python')
-            args.update(options._options)
-            args['tail'] = options.tail
-            args['head'] = options.head
-            cmd = grep_process_cmd % args
-
-            debug(args)
-            debug(cmd)
-            hook_file_grep = weechat.hook_process(cmd, timeout, 'grep_file_callback', tmpFile.name)
-            if hook_file_grep:
-                buffer_create("Searching for '%s' in %s worth of data..." % (options.pattern_tmpl,
-                                                                             human_readable_size(size)))
+            global background_grep
+            workers = max(get_config_int('workers'), 1)
+            # results found already must be shown first
+            stream = not (matched_lines or [ log for log in search_cache
+                                                    if search_cache[log][2] is not None ])
+            background_grep = BackgroundGrep(files, size, ranges, stream)
+            background_grep.start(workers)
     else:
+        cache_results(matched_lines)
         buffer_update()
 
-# defined here for commodity
-grep_process_cmd = """%(python)s -%(bytecode)sc '
-import sys, cPickle, os
-sys.path.append("%(script_path)s") # add WeeChat script dir so we can import grep
-from grep import make_regexp, grep_file, strip_home
-logs = (%(logs)s, )
-try:
-    regexp = make_regexp("%(pattern)s", %(matchcase)s)
-    d = {}
+def get_range_size(log, ranges):
+    """Size of the data of 'log' to search, 'ranges' is like in shard_files()."""
+    if log in ranges:
+        start, end = ranges[log]
+        if end is not None:
+            return end - start
+        return get_data_size(log) - start
+    return get_data_size(log)
+
+SHARD_MIN_SIZE = 4*1024*1024 # 4 MiB
+def shard_files(files, workers, split=True, ranges={}):
+    """
+    Distributes 'files' among a list of 'workers' lists of shards (log, start, end), so each
+    process greps about the same amount of data. If 'split' is true, logs bigger than their
+    share are split in byte ranges aligned to line boundaries, except compressed ones. 'ranges'
+    has the offsets (start, end) of the part to search of some logs, the whole log otherwise.
+    Shards keep the order of 'files'.
+    """
+    sizes = [ get_range_size(log, ranges) for log in files ]
+    share = max(sum(sizes) / workers, SHARD_MIN_SIZE)
+    shards = []
+    for i, log in enumerate(files):
+        size = sizes[i]
+        first, last = ranges.get(log, (0, None))
+        n = min(workers, size / share)
+        if not split or n < 2 or is_compressed(log):
+            # compressed logs are searched whole, but each one by a different process if possible
+            shards.append((size, i, log, first, last))
+            continue
+        bounds = [first]
+        fd = open(log, 'rb')
+        try:
+            for k in range(1, n):
+                fd.seek(first + k * size / n)
+                fd.readline() # move cursor to next line
+                offset = fd.tell()
+                if bounds[-1] < offset < first + size:
+                    bounds.append(offset)
+        finally:
+            fd.close()
+        bounds.append(first + size)
+        for k in range(len(bounds) - 1):
+            start, end = bounds[k], bounds[k + 1]
+            if k == len(bounds) - 2:
+                # last shard reads until the end of the range, or EOF since the log might have
+                # grown
+                end = last
+            shards.append((bounds[k + 1] - start, i, log, start, end))
+
+    # biggest shards first, each one to the least loaded worker
+    shards.sort(reverse=True)
+    loads = [ [0, []] for i in range(workers) ]
+    for size, i, log, start, end in shards:
+        load = min(loads)
+        load[0] += size
+        load[1].append((i, start, log, end))
+    result = []
+    for size, L in loads:
+        if L:
+            L.sort()
+            result.append([ (log, start, end) for i, start, log, end in L ])
+    return result
+
+def merge_shards(results):
+    """Stores in matched_lines the lines found in each shard, joining the shards of the same log."""
+    logs = {}
+    for (log_name, start), lines in results.iteritems():
+        logs.setdefault(log_name, []).append((start, lines))
+    limit = options.head or options.tail
+    for log_name, shards in logs.iteritems():
+        if len(shards) == 1:
+            matched_lines[log_name] = shards[0][1]
+            continue
+        shards.sort()
+        lines = make_lines(log_name)
+        for start, L in shards:
+            lines.extend(L)
+            lines.matches_count += L.matches_count
+            lines.stripped_lines += L.stripped_lines
+        if limit and lines.matches_count > limit:
+            # logs are split only without context options, so each line is a match
+            if options.head:
+                del lines[limit:]
+            else:
+                del lines[:-limit]
+            lines.matches_count = limit
+        matched_lines[log_name] = lines
+
+### Foreground grep ###
+SLICE_TIME = 0.05 # seconds
+class ForegroundGrep(object):
+    """
+    A search done in WeeChat's process, in slices of about SLICE_TIME seconds run from a timer,
+    so WeeChat isn't blocked meanwhile and the search can be stopped. Jobs are generators that
+    search a step each time they're resumed, like grep_file_steps(). 'size' is the amount of data
+    to search, for showing the progress.
+    """
+    def __init__(self, where, size=0):
+        self.where = where
+        self.size = size
+        self.jobs = deque()
+        self.scanned = {} # log -> bytes read
+        self.timer = None
+
+    def add(self, job):
+        self.jobs.append(job)
+
+    def make_progress(self, log):
+        """Returns a function for grep_file() that keeps the bytes read of 'log'."""
+        def progress(size):
+            self.scanned[log] = size
+        return progress
+
+    def start(self):
+        """Runs the first slice, returns True if the search is already over."""
+        if self.run():
+            self.end()
+            return True
+        self.timer = weechat.hook_timer(1, 0, 0, 'foreground_grep_cb', '')
+        self.update_title()
+        return False
+
+    def run(self):
+        """Searches until the slice time is over, returns True if all jobs are done."""
+        jobs = self.jobs
+        time_end = now() + SLICE_TIME
+        while jobs:
+            try:
+                jobs[0].next()
+            except StopIteration:
+                jobs.popleft()
+                continue
+            if now() > time_end:
+                return False
+        return True
+
+    def stop(self):
+        if self.timer:
+            weechat.unhook(self.timer)
+            self.timer = None
+        for job in self.jobs:
+            # closes the logs in use
+            job.close()
+        self.jobs.clear()
+
+    def update_title(self):
+        buffer_create(make_progress_title(self.where, sum(self.scanned.itervalues()), self.size,
+                                          matched_lines.get_matches_count()))
+
+    def end(self):
+        """All jobs are done, shows the results."""
+        global matched_lines
+        cache_results(matched_lines)
+        if options.merge and len(matched_lines.keys()) > 1:
+            matched_lines = merge_buffers(matched_lines)
+        buffer_update()
+
+foreground_grep = None
+def start_foreground_grep(search):
+    global foreground_grep
+    foreground_grep = search
+    try:
+        if search.start():
+            foreground_grep = None
+    except:
+        search.stop()
+        foreground_grep = None
+        raise
+
+def foreground_grep_cb(data, remaining_calls):
+    global foreground_grep
+    search = foreground_grep
+    if search is None:
+        return WEECHAT_RC_OK
+    try:
+        if search.run():
+            search.stop()
+            foreground_grep = None
+            search.end()
+        else:
+            search.update_title()
+    except Exception, e:
+        search.stop()
+        foreground_grep = None
+        error(e)
+    return WEECHAT_RC_OK
+
+def merge_buffers(results):
+    """
+    Merges the matches of all buffers in 'results' (a linesDict) in one linesList sorted by date,
+    lines are marked with the short name of their buffer. With context options paragraphs are
+    kept together.
+    """
+    separator = linesList._sep
+    context = options.after_context or options.before_context
+    def paragraphs(name, lines):
+        paragraph = []
+        for line in lines:
+            if line == separator or (paragraph and not context):
+                # without context options each line is a paragraph
+                if paragraph:
+                    yield paragraph[0][:DATE_LEN], paragraph
+                paragraph = []
+                if line == separator:
+                    continue
+            if line.count('\t') < 2:
+                # not from a buffer with dates, like grep's
+                paragraph.append(line)
+                continue
+            date, prefix, message = line.split('\t', 2)
+            paragraph.append('%s\t%s\t%s%s%s %s' % (date, prefix, color_summary, name,
+                                                   color_reset, message))
+        if paragraph:
+            yield paragraph[0][:DATE_LEN], paragraph
+
+    where = '%s buffers' % len(results.keys())
+    merged = make_lines(where)
+    iterables = []
+    for buffer_name, lines in results.iteritems():
+        merged.matches_count += lines.matches_count
+        merged.stripped_lines += lines.stripped_lines
+        if not lines:
+            continue
+        buffer = getattr(lines, 'buffer', '')
+        name = buffer and weechat.buffer_get_string(buffer, 'short_name') or buffer_name
+        iterables.append(paragraphs(name, lines))
+    for date, paragraph in heapq.merge(*iterables):
+        if context:
+            merged.append_separator()
+        merged.extend(paragraph)
+    merged_lines = linesDict()
+    merged_lines[where] = merged
+    return merged_lines
+
+### Background grep ###
+# Processes send their results as records, a header "<kind> <shard> <size>\n" followed by <size>
+# bytes of payload. Kinds are lines (several, joined by newlines), separator, progress (bytes read),
+# garbage (the shard had NUL bytes) and end (matches count). Records are text, WeeChat passes the
+# output of processes as a C string, so NULs are removed from lines.
+RECORD_LINES, RECORD_SEPARATOR, RECORD_PROGRESS, RECORD_GARBAGE, RECORD_END = 'lspge'
+RECORD_BATCH = 256 # lines sent in a record
+
+def write_record(write, kind, shard, payload=''):
+    write('%s %s %s\n%s' % (kind, shard, len(payload), payload))
+
+class streamLinesList(linesList):
+    """linesList that writes lines to 'output' as records instead of keeping them, a batch of
+    RECORD_BATCH lines at a time."""
+    def __init__(self, shard, output):
+        linesList.__init__(self)
+        self.shard = shard
+        self.write = output.write
+        self.batch = []
+        self.last = None
+        self.found_garbage = False
+
+    def append(self, item):
+        batch = self.batch
+        if isinstance(item, str):
+            item = [ item ]
+        for line in item:
+            if '\x00' in line:
+                self.found_garbage = True
+                line = line.replace('\x00', '')
+            batch.append(line.rstrip('\n'))
+        if len(batch) >= RECORD_BATCH:
+            self.flush()
+        self.last = RECORD_LINES
+
+    def append_separator(self):
+        if self.last == RECORD_LINES:
+            self.flush()
+            write_record(self.write, RECORD_SEPARATOR, self.shard)
+            self.last = RECORD_SEPARATOR
+
+    def flush(self):
+        """Writes the lines not sent yet."""
+        if self.batch:
+            write_record(self.write, RECORD_LINES, self.shard, '\n'.join(self.batch))
+            del self.batch[:]
+
+def grep_shards(shards, pattern, matchcase, head, tail, after_context, before_context, count,
+                hilight, exact, invert, fast, since='', until='', nick='', date='', text=False):
+    """Greps 'shards' (shard, log, start, end) and writes the results in stdout, runs in the
+    background process."""
+    dates = None
+    if since or until:
+        # shards of plain logs are already in range, compressed ones are filtered while read
+        dates = since, until
+    fields = None
+    if nick or date or text:
+        fields = nick, date, text
+    output = sys.stdout
+    write = output.write
+    regexp = make_regexp(pattern, matchcase)
+    # with tail lines are found backwards, they're sent after reversing them
+    stream = not tail
+    for shard, log, start, end in shards:
+        records = streamLinesList(shard, output)
+        def progress(size):
+            if stream:
+                records.flush()
+            write_record(write, RECORD_PROGRESS, shard, str(size))
+            output.flush()
+        if stream:
+            lines = records
+        else:
+            lines = linesList()
+        lines = grep_file(log, head, tail, after_context, before_context, count, regexp,
+                          hilight, exact, invert, start, end, lines, progress, fast, dates,
+                          fields)
+        if not stream:
+            for line in lines:
+                if line == linesList._sep:
+                    records.append_separator()
+                else:
+                    records.append(line)
+        records.flush()
+        if records.found_garbage:
+            write_record(write, RECORD_GARBAGE, shard)
+        write_record(write, RECORD_END, shard, str(lines.matches_count))
+        output.flush()
+
+def build_indexes(logs, index_dir):
+    """Builds the index of 'logs', runs in the background process."""
     for log in logs:
-        log_name = strip_home(log, "%(home_dir)s")
-        lines = grep_file(log, %(head)s, %(tail)s, %(after_context)s, %(before_context)s,
-        %(count)s, regexp, "%(hilight)s", %(exact)s, %(invert)s)
-        d[log_name] = lines
-    fd = open("%(filename)s", "wb")
-    cPickle.dump(d, fd, -1)
-    fd.close()
-except Exception, e:
-    print >> sys.stderr, e'
-"""
+        try:
+            LogIndex(log, index_dir).build()
+        except Exception, e:
+            print >> sys.stderr, '%s: %s' % (log, e)
+
+# Background processes import this script and run one of these functions, with its arguments
+# encoded in the command line, so nothing of the search ends in the process' code.
+workers = {
+        'grep': grep_shards,
+        'index': build_indexes,
+        }
 
-grep_stdout = grep_stderr = ''
-def grep_file_callback(filename, command, rc, stdout, stderr):
-    global hook_file_grep, grep_stderr,  grep_stdout
-    global matched_lines
+process_cmd = "%(python)s -%(bytecode)sc 'import sys; sys.path.append(sys.argv[1]); " \
+              "import grep; grep.run_worker(sys.argv[2], sys.argv[3])' %(script_path)s " \
+              "%(worker)s %(args)s"
+
+def make_process_cmd(worker, **kwargs):
+    """Returns the command for hook_process() that calls 'worker' with 'kwargs'."""
+    global script_path, bytecode
+    python = weechat.info_get('python2_bin', '') or 'python'
+    return process_cmd % dict(python=pipes.quote(python),
+                              bytecode=bytecode,
+                              script_path=pipes.quote(script_path),
+                              worker=worker,
+                              args=base64.b64encode(marshal.dumps(kwargs)))
+
+def run_worker(worker, args):
+    """Entry point of background processes, 'args' is encoded by make_process_cmd()."""
+    try:
+        workers[worker](**marshal.loads(base64.b64decode(args)))
+    except Exception, e:
+        print >> sys.stderr, e
+
+class BackgroundGrep(object):
+    """
+    A search running in background processes. Results are received as records and, unless the
+    options need all the lines first (like --tail or --count) or 'stream' is false, printed in grep
+    buffer as soon as all the previous shards are done, so lines are shown in order.
+    """
+    def __init__(self, files, size, ranges={}, stream=True):
+        self.files = files
+        self.size = size
+        self.ranges = ranges # log -> (start, end) to search
+        self.shards = []     # list of (log, start, end), in the order they're shown
+        self.results = {}    # shard -> linesList
+        self.scanned = {}    # shard -> bytes read
+        self.done = set()
+        self.garbage = set() # logs with NUL bytes, already reported
+        self.processes = {}  # id -> [hook, stdout not parsed yet, stderr]
+        self.stream = stream and not (options.count or options.tail or options.exact)
+        self.kept = {}       # log -> linesList with the lines printed, for result_cache
+        self.next_shard = 0  # next shard to print
+        self.max_lines = get_config_int('max_lines')
+        # results with more lines than this aren't cached, so they aren't kept either
+        self.max_kept = min(get_config_int('cache_size'), self.max_lines)
+        self.printed_lines = 0
+        self.matches_count = 0
+        self.found_lines = 0
+        self.log_printed = 0
+        self.log_matches = 0
+        self.log_separator = False
+
+    def start(self, workers):
+        timeout = 1000*60*5 # 5 min
+        # big logs can only be split if we don't need lines around matches
+        split = not (options.after_context or options.before_context)
+        shards_list = shard_files(self.files, workers, split, self.ranges)
+        order = [ (self.files.index(log), start, log, end) for L in shards_list
+                                                           for log, start, end in L ]
+        order.sort()
+        self.shards = [ (log, start, end) for i, start, log, end in order ]
+        logs = [ log for log, start, end in self.shards ]
+        self.split_logs = set([ log for log in logs if logs.count(log) > 1 ])
+        shard_id = dict([ ((log, start), i) for i, (log, start, end) in enumerate(self.shards) ])
+        self.shard_sizes = {}
+        for i, (log, start, end) in enumerate(self.shards):
+            if self.stream:
+                # a shard can't be shown until the previous ones are done, meanwhile it keeps the
+                # lines that might be shown, the rest goes to spill file after the lines kept
+                spill = spill_file and spill_file.writer(strip_home(log), (i, 1))
+                self.results[i] = boundedLinesList(max(self.max_lines, 1), spill, first=True)
+            elif options.tail:
+                self.results[i] = linesList()
+            else:
+                self.results[i] = boundedLinesList(max(self.max_lines, 1))
+            self.scanned[i] = 0
+            if self.stream and log in search_cache:
+                self.kept[strip_home(log)] = linesList()
+            if end is None:
+                self.shard_sizes[i] = get_data_size(log) - start
+            else:
+                self.shard_sizes[i] = end - start
+
+        for n, shards in enumerate(shards_list):
+            shards = [ (shard_id[log, start], log, start, end) for log, start, end in shards ]
+            cmd = make_process_cmd('grep', shards=shards,
+                                   pattern=options.pattern,
+                                   matchcase=options.matchcase,
+                                   head=options.head,
+                                   tail=options.tail,
+                                   after_context=options.after_context,
+                                   before_context=options.before_context,
+                                   count=options.count,
+                                   hilight=options.hilight or '',
+                                   exact=options.exact,
+                                   invert=options.invert,
+                                   fast=get_config_boolean('use_mmap'),
+                                   since=options.since,
+                                   until=options.until,
+                                   nick=options.nick,
+                                   date=options.date,
+                                   text=options.text)
+            debug(cmd)
+            hook = weechat.hook_process(cmd, timeout, 'grep_file_callback', str(n))
+            if hook:
+                self.processes[str(n)] = [hook, '', '']
+        if self.processes:
+            buffer = buffer_create()
+            if self.stream:
+                if get_config_boolean('clear_buffer'):
+                    weechat.buffer_clear(buffer)
+                where = len(self.files) == 1 and strip_home(self.files[0]) \
+                                              or '%s logs' % len(self.files)
+                print_search_header(buffer, where)
+                self.format_line = make_format_line()
+            self.update_title()
+
+    def stop(self):
+        for hook, stdout, stderr in self.processes.itervalues():
+            weechat.unhook(hook)
+        self.processes = {}
+
+    def feed(self, id, stdout, stderr):
+        """Parses the output of process 'id'."""
+        process = self.processes[id]
+        process[2] += stderr
+        data = process[1] + stdout
+        pos, size = 0, len(data)
+        while pos < size:
+            header_end = data.find('\n', pos)
+            if header_end < 0:
+                break
+            kind, shard, length = data[pos:header_end].split(' ')
+            payload_end = header_end + 1 + int(length)
+            if payload_end > size:
+                break
+            payload = data[header_end + 1:payload_end]
+            pos = payload_end
+            shard = int(shard)
+            if kind == RECORD_LINES:
+                lines = payload.split('\n')
+                self.results[shard].extend(lines)
+                self.found_lines += len(lines)
+            elif kind == RECORD_SEPARATOR:
+                self.results[shard].append_separator()
+            elif kind == RECORD_PROGRESS:
+                # compressed log sizes are just estimated
+                self.scanned[shard] = min(int(payload), self.shard_sizes[shard])
+            elif kind == RECORD_GARBAGE:
+                log = self.shards[shard][0]
+                if log not in self.garbage:
+                    # log was corrupted
+                    self.garbage.add(log)
+                    error("Found garbage in log '%s', maybe it's corrupted" % strip_home(log))
+            elif kind == RECORD_END:
+                self.results[shard].matches_count = int(payload)
+                self.scanned[shard] = self.shard_sizes[shard]
+                self.done.add(shard)
+        process[1] = data[pos:]
+        if self.stream:
+            self.print_shards()
+
+    def finish(self, id):
+        """Process 'id' is over, returns True if it was the last one."""
+        del self.processes[id]
+        return not self.processes
+
+    def get_stderr(self):
+        return ''.join([ process[2] for process in self.processes.itervalues() ])
+
+    def print_shards(self):
+        """Prints the lines of the shards that are next in order."""
+        buffer = buffer_create()
+        shards = self.shards
+        while self.next_shard < len(shards):
+            i = self.next_shard
+            log = strip_home(shards[i][0])
+            lines = self.results[i]
+            # logs are split only without context options, so in these each line is a match
+            split = shards[i][0] in self.split_logs
+            limit = split and options.head
+            self.print_log_lines(buffer, log, lines, limit, i)
+            del lines[:]
+            if lines.stripped_lines and log in self.kept:
+                # lines over the bound went to spill file, results can't be cached
+                del self.kept[log]
+                search_cache.pop(shards[i][0], None)
+            if i not in self.done:
+                break
+            self.log_matches += lines.matches_count
+            self.next_shard += 1
+            if self.next_shard == len(shards) or shards[self.next_shard][0] != shards[i][0]:
+                # log is over
+                self.print_log_summary(buffer, log, limit)
+
+    def print_log_lines(self, buffer, log, lines, limit=0, shard=0):
+        separator = linesList._sep
+        shown = []  # lines for grep buffer, printed in batches
+        hidden = [] # lines for spill file
+        kept = self.kept.get(log)
+        for line in lines:
+            if line == separator:
+                self.log_separator = self.log_printed > 0
+                continue
+            if limit and self.log_printed >= limit:
+                break
+            self.log_printed += 1
+            if kept is not None and len(kept) >= self.max_kept:
+                # too many lines, results can't be cached
+                del self.kept[log]
+                search_cache.pop(self.shards[shard][0], None)
+                kept = None
+            if kept is not None:
+                if self.log_separator:
+                    kept.append(separator)
+                kept.append(line)
+            if self.printed_lines < self.max_lines:
+                if self.log_separator:
+                    shown.append(separator)
+                shown.append(line)
+                self.printed_lines += 1
+            elif spill_file:
+                if self.log_separator:
+                    hidden.append(separator)
+                hidden.append(line)
+            self.log_separator = False
+        if shown:
+            print_lines(buffer, log, shown, self.format_line)
+        if hidden:
+            spill_file.write(log, hidden, (shard, 0))
+
+    def print_log_summary(self, buffer, log, limit=0):
+        matches = self.log_matches
+        if limit:
+            matches = min(matches, limit)
+        self.matches_count += matches
+        if log in self.kept:
+            self.kept[log].matches_count = matches
+        if matches and get_config_boolean('show_summary'):
+            note = ''
+            if self.printed_lines >= self.max_lines:
+                note = ' (first %s lines shown)' % self.max_lines
+            print_line(make_summary(log, matches, note), buffer)
+        if self.log_printed:
+            prnt(buffer, '\n')
+        self.log_printed = self.log_matches = 0
+        self.log_separator = False
+
+    def update_title(self):
+        where = len(self.files) == 1 and strip_home(self.files[0]) or '%s logs' % len(self.files)
+        buffer_create(make_progress_title(where, sum(self.scanned.itervalues()), self.size,
+                                          self.found_lines))
+
+    def end(self):
+        """All processes are done, shows the results."""
+        global matched_lines, time_start
+        if not self.stream:
+            results = {}
+            for i, (log, start, end) in enumerate(self.shards):
+                results[strip_home(log), start] = self.results[i]
+            merge_shards(results)
+            cache_results(matched_lines)
+            buffer_update()
+            return
+        cache_results(self.kept)
+        buffer = buffer_create()
+        if not self.matches_count:
+            print_line('No matches found.', buffer)
+        print_more_hint(buffer)
+        time_total = now() - time_start
+        note = ''
+        if self.printed_lines >= self.max_lines:
+            note = ' (first %s lines shown)' % self.max_lines
+        where = len(self.files) == 1 and strip_home(self.files[0]) or '%s logs' % len(self.files)
+        weechat.buffer_set(buffer, 'title', make_title(where, self.matches_count, note,
+                                                       time_total, 100.0))
+        if get_config_boolean('go_to_buffer'):
+            weechat.buffer_set(buffer, 'display', '1')
+
+background_grep = None
+def grep_file_callback(id, command, rc, stdout, stderr):
+    global background_grep
     #debug("rc: %s\nstderr: %s\nstdout: %s" %(rc, repr(stderr), repr(stdout)))
-    if stdout:
-        grep_stdout += stdout
-    if stderr:
-        grep_stderr += stderr
-    if int(rc) >= 0:
-  
-        def set_buffer_error():
+    search = background_grep
+    if search is None or id not in search.processes:
+        # search was stopped
+        return WEECHAT_RC_OK
+    try:
+        search.feed(id, stdout, stderr)
+        if int(rc) < 0:
+            search.update_title()
+            return WEECHAT_RC_OK
+        stderr = search.get_stderr()
+        if not search.finish(id):
+            if stderr:
+                # don't bother waiting for the others
+                search.stop()
+            else:
+                search.update_title()
+                return WEECHAT_RC_OK
+        background_grep = None
+        if stderr:
+            error(stderr)
             grep_buffer = buffer_create()
             title = weechat.buffer_get_string(grep_buffer, 'title')
             title = title + ' %serror' %color_title
             weechat.buffer_set(grep_buffer, 'title', title)
-
-        try:
-            if grep_stderr:
-                error(grep_stderr)
-                set_buffer_error()
-            #elif grep_stdout:
-                #debug(grep_stdout)
-            elif path.exists(filename):
-                import cPickle
-                try:
-                    #debug(file)
-                    fd = open(filename, 'rb')
-                    d = cPickle.load(fd)
-                    matched_lines.update(d)
-                    fd.close()
-                except Exception, e:
-                    error(e)
-                    set_buffer_error()
-                else:
-                    buffer_update()
-            global tmpFile
-            tmpFile = None
-        finally:
-            grep_stdout = grep_stderr = ''
-            hook_file_grep = None
+        else:
+            search.end()
+    except Exception, e:
+        search.stop()
+        background_grep = None
+        error(e)
     return WEECHAT_RC_OK
 
 def get_grep_file_status():
     global search_in_files, matched_lines, time_start
     elapsed = now() - time_start
-    if len(search_in_files) == 1:
+    if search_in_buffers:
+        log = '%s buffers' % len(search_in_buffers)
+    elif len(search_in_files) == 1:
         log = '%s (%s)' %(strip_home(search_in_files[0]),
                 human_readable_size(get_size(search_in_files[0])))
     else:
@@ -1098,111 +3463,179 @@ def get_grep_file_status():
         ' in grep buffer.' %(log, elapsed)
 
 ### Grep buffer ###
-def buffer_update():
-    """Updates our buffer with new lines."""
-    global matched_lines
-    time_grep = now()
-
-    buffer = buffer_create()
-    if get_config_boolean('clear_buffer'):
-        weechat.buffer_clear(buffer)
-    matched_lines.strip_separator() # remove first and last separators of each list
-    len_total_lines = len(matched_lines)
-    max_lines = get_config_int('max_lines')
-    if not options.count and len_total_lines > max_lines:
-        weechat.buffer_clear(buffer)
-
-    def _make_summary(log, lines, note):
-        return '%s matches "%s%s%s"%s in %s%s%s%s' % (lines.matches_count, 
-                                                      color_summary,
-                                                      options.pattern_tmpl,
-                                                      color_info,
-                                                      options.invert and ' (inverted)' or '',
-                                                      color_summary,
-                                                      log, color_reset, note)
+def make_summary(log, matches_count, note=''):
+    return '%s matches "%s%s%s"%s in %s%s%s%s' % (matches_count,
+                                                  color_summary,
+                                                  options.pattern_tmpl,
+                                                  color_info,
+                                                  options.invert and ' (inverted)' or '',
+                                                  color_summary,
+                                                  log, color_reset, note)
+
+def make_title(where, matches_count, note, time_total, time_grep_pct):
+    return "Search in %s%s%s %s matches%s | pattern \"%s%s%s\"%s %s | %.4f seconds (%.2f%%)" \
+                % (color_title, where, color_reset,
+                   matches_count, note,
+                   color_title, options.pattern_tmpl, color_reset,
+                   options.invert and ' (inverted)' or '',
+                   format_options(), time_total, time_grep_pct)
 
-    if options.count:
-        make_summary = lambda log, lines : _make_summary(log, lines, ' (not shown)')
+def make_progress_title(where, scanned, size, matches_count):
+    if size:
+        progress = '%s of %s, ' % (human_readable_size(scanned), human_readable_size(size))
     else:
-        def make_summary(log, lines):
-            if lines.stripped_lines:
-                if lines:
-                    note = ' (last %s lines shown)' % len(lines)
-                else:
-                    note = ' (not shown)'
-            else:
-                note = ''
-            return _make_summary(log, lines, note)
+        progress = ''
+    return "Searching for '%s' in %s: %s%s matching lines. Interrupt it with \"/grep stop\"" \
+            % (options.pattern_tmpl, where, progress, matches_count)
 
-    global weechat_format
+def make_format_line():
+    """Returns the function for format the lines printed in grep buffer."""
     if options.hilight:
         # we don't want colors if there's match highlighting
         format_line = lambda s : '%s %s %s' % split_line(s)
     else:
+        # nicks of this search, so the LRU order is only updated once for each nick
+        nick_dict = {}
+        get_nick_color = nick_colors.get_color
         def format_line(s):
-            global nick_dict, weechat_format
             date, nick, msg = split_line(s)
             if weechat_format:
                 try:
                     nick = nick_dict[nick]
                 except KeyError:
-                    # cache nick
-                    nick_c = color_nick(nick)
-                    nick_dict[nick] = nick_c
-                    nick = nick_c
+                    nick = nick_dict[nick] = get_nick_color(nick)
                 return '%s%s %s%s %s' % (color_date, date, nick, color_reset, msg)
             else:
                 #no formatting
                 return msg
+    return format_line
+
+RENDER_BATCH = 100 # lines formatted and printed at once
+def print_lines(buffer, log, lines, format_line):
+    """Prints the matched 'lines' of 'log' in grep buffer."""
+    for step in print_lines_steps(buffer, log, lines, format_line):
+        pass
 
+def print_lines_steps(buffer, log, lines, format_line, batch=RENDER_BATCH):
+    """
+    Generator version of print_lines(), yields the number of lines printed after each batch.
+    Lines of a batch are printed with a single call, WeeChat splits them.
+    """
+    global weechat_format
+    weechat_format = True
+    sep = linesList._sep
+    found_garbage = False
+    for i in xrange(0, len(lines), batch):
+        L = []
+        append = L.append
+        for line in lines[i:i + batch]:
+            if line == sep:
+                append(context_sep)
+            else:
+                if '\x00' in line:
+                    found_garbage = True
+                    line = line.replace('\x00', '')
+                # trailing newlines would print empty lines
+                append(format_line(line).rstrip('\n'))
+        prnt_date_tags(buffer, 0, 'no_highlight', '\n'.join(L))
+        yield len(L)
+    if found_garbage:
+        # log was corrupted
+        error("Found garbage in log '%s', maybe it's corrupted" % log)
+
+def print_more_hint(buffer):
+    """Tells how many lines of the last search weren't shown yet, if they're in spill file."""
+    global spill_file
+    if not spill_file:
+        return
+    left = spill_file.lines - spill_file.shown
+    if left:
+        print_line('%s lines not shown, use "/grep more" for the next %s.' \
+                   % (left, min(left, get_config_int('max_lines'))), buffer)
+    else:
+        spill_file.close()
+        spill_file = None
+
+def print_search_header(buffer, where):
     prnt(buffer, '\n')
     print_line('Search for "%s%s%s"%s in %s%s%s.' % (color_summary,
                                                      options.pattern_tmpl,
                                                      color_info,
                                                      options.invert and ' (inverted)' or '',
-                                                     color_summary, 
-                                                     matched_lines,
+                                                     color_summary,
+                                                     where,
                                                      color_reset),
             buffer)
+
+def buffer_update():
+    """Updates our buffer with new lines. The first lines are printed right away, the rest from a
+    timer, see start_render()."""
+    global matched_lines
+    time_grep = now()
+    results = matched_lines
+    # free matched_lines so it can be removed from memory once printed
+    del matched_lines
+
+    buffer = buffer_create()
+    if get_config_boolean('clear_buffer'):
+        weechat.buffer_clear(buffer)
+    results.strip_separator() # remove first and last separators of each list
+    # lines might have been removed already, if there were too many
+    len_total_lines = len(results) + results.get_stripped_lines()
+    max_lines = get_config_int('max_lines')
+    if not options.count and len_total_lines > max_lines:
+        weechat.buffer_clear(buffer)
+
+    print_search_header(buffer, results)
+    if get_config_boolean('go_to_buffer'):
+        weechat.buffer_set(buffer, 'display', '1')
+    start_render(buffer_update_steps(buffer, results, time_grep, len_total_lines, max_lines))
+
+def buffer_update_steps(buffer, results, time_grep, len_total_lines, max_lines):
+    """Prints the results in grep buffer, yields the number of lines printed after each batch."""
+    if options.count:
+        summary = lambda log, lines : make_summary(log, lines.matches_count, ' (not shown)')
+    else:
+        def summary(log, lines):
+            if lines.stripped_lines:
+                if lines:
+                    note = ' (last %s lines shown)' % len(lines)
+                else:
+                    note = ' (not shown)'
+            else:
+                note = ''
+            return make_summary(log, lines.matches_count, note)
+
+    format_line = make_format_line()
     # print last <max_lines> lines
-    if matched_lines.get_matches_count():
+    if results.get_matches_count():
         if options.count:
             # with count we sort by matches lines instead of just lines.
-            matched_lines_items = matched_lines.items_count()
+            results_items = results.items_count()
         else:
-            matched_lines_items = matched_lines.items()
+            results_items = results.items()
 
-        matched_lines.get_last_lines(max_lines)
-        for log, lines in matched_lines_items:
+        results.get_last_lines(max_lines)
+        for log, lines in results_items:
             if lines.matches_count:
                 # matched lines
                 if not options.count:
                     # print lines
-                    weechat_format = True
                     if options.exact:
                         lines.onlyUniq()
-                    for line in lines:
-                        #debug(repr(line))
-                        if line == linesList._sep:
-                            # separator
-                            prnt(buffer, context_sep)
-                        else:
-                            if '\x00' in line:
-                                # log was corrupted
-                                error("Found garbage in log '%s', maybe it's corrupted" % log)
-                                line = line.replace('\x00', '')
-                            prnt_date_tags(buffer, 0, 'no_highlight', format_line(line))
+                    for step in print_lines_steps(buffer, log, lines, format_line):
+                        yield step
 
                 # summary
                 if options.count or get_config_boolean('show_summary'):
-                    summary = make_summary(log, lines)
-                    print_line(summary, buffer)
+                    print_line(summary(log, lines), buffer)
 
             # separator
             if not options.count and lines:
                 prnt(buffer, '\n')
     else:
         print_line('No matches found.', buffer)
+    print_more_hint(buffer)
 
     # set title
     global time_start
@@ -1213,23 +3646,64 @@ def buffer_update():
     time_grep_pct = (time_grep - time_start)/time_total*100
     #debug('time: %.4f seconds (%.2f%%)' %(time_total, time_grep_pct))
     if not options.count and len_total_lines > max_lines:
-        note = ' (last %s lines shown)' % len(matched_lines)
+        note = ' (last %s lines shown)' % len(results)
     else:
         note = ''
-    title = "Search in %s%s%s %s matches%s | pattern \"%s%s%s\"%s %s | %.4f seconds (%.2f%%)" \
-                % (color_title, matched_lines, color_reset,
-                   matched_lines.get_matches_count(), note,
-                   color_title, options.pattern_tmpl, color_reset,
-                   options.invert and ' (inverted)' or '',
-                   format_options(), time_total, time_grep_pct)
+    title = make_title(results, results.get_matches_count(), note, time_total,
+                       time_grep_pct)
     weechat.buffer_set(buffer, 'title', title)
 
-    if get_config_boolean('go_to_buffer'):
-        weechat.buffer_set(buffer, 'display', '1')
+# Results are printed in batches, the first RENDER_FIRST lines right away so the first screen
+# appears at once, the rest in slices of SLICE_TIME from a timer so WeeChat isn't blocked while
+# printing many lines.
+RENDER_FIRST = 200
+render_job = None
+render_timer = None
+
+def start_render(job):
+    """Runs 'job', a generator that prints a batch each time is resumed and yields the number of
+    lines printed."""
+    global render_job, render_timer
+    stop_render()
+    printed = 0
+    try:
+        for n in job:
+            printed += n
+            if printed >= RENDER_FIRST:
+                render_job = job
+                render_timer = weechat.hook_timer(1, 0, 0, 'render_cb', '')
+                return
+    except Exception, e:
+        error(e)
+
+def stop_render(finish=False):
+    """Stops printing results, or prints all the remaining ones at once if 'finish'."""
+    global render_job, render_timer
+    job = render_job
+    if render_timer:
+        weechat.unhook(render_timer)
+    render_job = render_timer = None
+    if job and finish:
+        try:
+            for n in job:
+                pass
+        except Exception, e:
+            error(e)
+
+def render_cb(data, remaining_calls):
+    job = render_job
+    if job is None:
+        return WEECHAT_RC_OK
+    time_end = now() + SLICE_TIME
+    try:
+        for n in job:
+            if now() > time_end:
+                return WEECHAT_RC_OK
+    except Exception, e:
+        error(e)
+    stop_render()
+    return WEECHAT_RC_OK
 
-    # free matched_lines so it can be removed from memory
-    del matched_lines
-    
 def split_line(s):
     """Splits log's line 's' in 3 parts, date, nick and msg."""
     global weechat_format
@@ -1291,6 +3765,25 @@ def format_options():
             append(' -A')
             append(options.after_context)
 
+    if options.merge:
+        append(' --merge')
+    if options.since:
+        append(' --since ')
+        append(options.since)
+    if options.until:
+        append(' --until ')
+        append(options.until)
+    if options.nick:
+        append(' --nick ')
+        append(options.nick)
+    if options.date:
+        append(' --date ')
+        append(options.date)
+    if options.text:
+        append(' --text')
+    if options.no_cache:
+        append(' --no-cache')
+
     s = ''.join(map(str, opts)).strip()
     if s and s[0] != '-':
         s = '-' + s
@@ -1339,19 +3832,14 @@ def buffer_input(data, buffer, input_data):
     return WEECHAT_RC_OK
 
 ### Commands ###
-def cmd_init():
-    """Resets global vars."""
-    global cache_dir, nick_dict
-    cache_dir = {} # for avoid walking the dir tree more than once per command
-    nick_dict = {} # nick cache for don't calculate nick color every time
-
 def cmd_grep_parsing(args):
     """Parses args for /grep and grep input buffer."""
-    global log_name, buffer_name
+    global log_name, buffer_name, reindex
     opts, args = getopt.gnu_getopt(args.split(), 'cmHehtivn:A:B:C:o',
                                    [ 'count', 'matchcase', 'hilight', 'exact', 'head', 'tail',
                                      'number=', 'after-context=', 'before-context=', 'context=',
-                                     'invert', 'only-match'])
+                                     'invert', 'only-match', 'reindex', 'since=', 'until=',
+                                     'merge', 'nick=', 'date=', 'text', 'no-cache'])
     #debug(opts, 'opts: '); debug(args, 'args: ')
     if len(args) >= 2:
         if args[0] == 'log':
@@ -1379,13 +3867,16 @@ def cmd_grep_parsing(args):
         except:
             return t
 
+    if ('--reindex', '') in opts:
+        # no pattern needed
+        reindex = True
+        return
+
     args = ' '.join(args) # join pattern for keep spaces
     if args:
         options.pattern_tmpl = args  
         options.pattern = _tmplRe.sub(tmplReplacer, args)
         debug('Using regexp: %s', options.pattern)
-    if not options.pattern:
-        raise Exception, 'No pattern for grep the logs.'
 
     def toggle(name):
         setattr(options, name, not getattr(options, name))
@@ -1421,23 +3912,76 @@ def cmd_grep_parsing(args):
             options.before_context = val
         elif opt in ('i', 'v', 'invert'):
             toggle('invert')
+        elif opt == 'merge':
+            toggle('merge')
+        elif opt == 'since':
+            options.since = val
+        elif opt == 'until':
+            options.until = val
+        elif opt == 'nick':
+            options.nick = val
+        elif opt == 'date':
+            options.date = val
+        elif opt == 'text':
+            toggle('text')
+        elif opt == 'no-cache':
+            toggle('no_cache')
+
+    if not options.pattern:
+        if not (options.nick or options.date):
+            raise Exception, 'No pattern for grep the logs.'
+        # all the lines of the nick or date
+        options.pattern = options.pattern_tmpl = '.*'
 
 def cmd_grep_stop(buffer, args):
-    global hook_file_grep, matched_lines, tmpFile
-    if hook_file_grep:
+    global background_grep, foreground_grep, matched_lines
+    search = background_grep or foreground_grep
+    if search:
         if args == 'stop':
-            weechat.unhook(hook_file_grep)
-            hook_file_grep = None
+            search.stop()
+            background_grep = foreground_grep = None
             s = 'Search for \'%s\' stopped.' % options.pattern
             say(s, buffer)
             grep_buffer = weechat.buffer_search('python', SCRIPT_NAME)
             if grep_buffer:
                 weechat.buffer_set(grep_buffer, 'title', s)
             del matched_lines
-            tmpFile = None
         else:
             say(get_grep_file_status(), buffer)
         raise Exception
+    elif render_job and args == 'stop':
+        stop_render()
+        say('Printing of results stopped.', buffer)
+        raise Exception
+
+def cmd_grep_more(buffer):
+    """Prints in grep buffer the next lines of the last search that weren't shown."""
+    # the lines of the last search must be printed before
+    stop_render(finish=True)
+    if not spill_file:
+        error("There aren't more lines to show, see spill_to_disk option.", buffer)
+        return
+    grep_buffer = buffer_create()
+    format_line = make_format_line()
+    page = spill_file.next_page(max(get_config_int('max_lines'), 1))
+    prnt(grep_buffer, '\n')
+    while page:
+        log = page[0][0]
+        n = 0
+        while n < len(page) and page[n][0] == log:
+            n += 1
+        lines = linesList([ item[1] for item in page[:n] ])
+        lines.strip_separator()
+        print_lines(grep_buffer, log, lines, format_line)
+        print_line('%s more lines of "%s%s%s" in %s%s%s' % (n, color_summary,
+                                                             options.pattern_tmpl,
+                                                             color_info,
+                                                             color_summary, log, color_reset),
+                   grep_buffer)
+        del page[:n]
+    print_more_hint(grep_buffer)
+    if get_config_boolean('go_to_buffer'):
+        weechat.buffer_set(grep_buffer, 'display', '1')
 
 def cmd_grep(data, buffer, args):
     """Search in buffers and logs."""
@@ -1450,10 +3994,14 @@ def cmd_grep(data, buffer, args):
         weechat.command('', '/help %s' %SCRIPT_COMMAND)
         return WEECHAT_RC_OK
 
-    cmd_init()
+    if args == 'more':
+        cmd_grep_more(buffer)
+        return WEECHAT_RC_OK
+
     options.reset()
-    global log_name, buffer_name
+    global log_name, buffer_name, reindex
     log_name = buffer_name = ''
+    reindex = False
 
     # parse
     try:
@@ -1481,6 +4029,13 @@ def cmd_grep(data, buffer, args):
         if not search_in_files:
             search_in_buffers = [ buffer ]
 
+    if reindex:
+        if search_in_files:
+            reindex_logs(search_in_files)
+        else:
+            error("Only logs can be indexed.")
+        return WEECHAT_RC_OK
+
     # grepping
     try:
         show_matching_lines()
@@ -1490,7 +4045,6 @@ def cmd_grep(data, buffer, args):
 
 def cmd_logs(data, buffer, args):
     """List files in Weechat's log dir."""
-    cmd_init()
     sort_by_size = False
     pattern = None
 
@@ -1506,24 +4060,30 @@ def cmd_logs(data, buffer, args):
         error('Argument error, %s' %e)
         return WEECHAT_RC_OK
 
-    home_dir = get_home()
-    file_list = dir_list(home_dir)
+    catalogue = get_catalogue()
     if pattern:
-        home_len = len(home_dir)
-        def match(file):
-            file = file[home_len:] # pattern shouldn't match home dir
-            if fnmatch(file, pattern):
-                return True
-            return False
-        
-        file_list = filter(match, file_list)
+        # pattern shouldn't match home dir
+        file_list = catalogue.match(pattern)
+    else:
+        file_list = catalogue.files()
 
     if sort_by_size:
         file_list.sort(key=get_size)
     else:
         file_list.sort()
 
-    file_sizes = map(lambda x: human_readable_size(get_size(x)), file_list)
+    def size_string(file):
+        size = human_readable_size(get_size(file))
+        if is_compressed(file):
+            uncompressed = get_uncompressed_size(file)
+            if uncompressed is None:
+                uncompressed = '?'
+            else:
+                uncompressed = human_readable_size(uncompressed)
+            size = '%s (%s)' % (size, uncompressed)
+        return size
+
+    file_sizes = map(size_string, file_list)
     # calculate column lenght
     if file_list:
         L = file_list[:]
@@ -1548,11 +4108,8 @@ def cmd_logs(data, buffer, args):
     return WEECHAT_RC_OK
 
 def cmd_lastlog(data, buffer, args):
+    """Search in the current buffer and show matches in it."""
     # XXX no pattern templates
-    # FIXME no help
-    # FIXME lacks features present in /grep, like --hilight --matchcase
-    pattern = args
-    nick_dict = {}
     # XXX make it configurable.
     max_lines = 100
 
@@ -1560,34 +4117,31 @@ def cmd_lastlog(data, buffer, args):
         date, nick, msg = s.split('\t', 2) # date, nick, message
         if '\t' in msg:
             msg = msg.replace('\t', '    ')
-        try:
-            nick = nick_dict[nick]
-        except KeyError:
-            # cache nick
-            nick_c = color_nick(nick)
-            nick_dict[nick] = nick_c
-            nick = nick_c
+        if not hilight:
+            # nicks aren't coloured with match highlighting, like in grep's buffer
+            nick = nick_colors.get_color(nick)
         return date, '%s%s\t%s' % (nick, color_reset, msg)
 
     try:
-        matched_lines = []
-        regexp = make_regexp(pattern)
-        infolist = weechat.infolist_get('buffer_lines', buffer, '')
-        while weechat.infolist_next(infolist):
-            tags = weechat.infolist_string(infolist, 'tags')
-            if 'grep' in tags:
-                continue
+        opts, args = getopt.gnu_getopt(args.split(), 'Hm', ['hilight', 'matchcase'])
+        pattern = ' '.join(args)
+        if not pattern:
+            raise Exception, 'No pattern for search the buffer.'
+        hilight = ''
+        matchcase = False
+        for opt, val in opts:
+            if opt in ('-H', '--hilight'):
+                hilight = '%s,%s' % (color_hilight, color_reset)
+            elif opt in ('-m', '--matchcase'):
+                matchcase = True
 
-            prefix = weechat.infolist_string(infolist, 'prefix') 
-            message = weechat.infolist_string(infolist, 'message')
-            line = "%s\t%s" % (prefix, message)
-            line_nocolor = weechat.string_remove_color(line, '')
-            if check_string(line_nocolor, regexp):
-                date = weechat.infolist_time(infolist, 'date')
-                date = time.strptime(date, "%Y-%m-%d %H:%M:%S")
-                date = int(time.mktime(date))
-                matched_lines.append((date, line))
-        weechat.infolist_free(infolist)
+        matched_lines = []
+        check = make_check(make_regexp(pattern, matchcase), hilight)
+        for line in get_buffer_lines(buffer):
+            # the date isn't searched
+            s = check(line[DATE_LEN + 1:])
+            if s:
+                matched_lines.append('%s\t%s' % (line[:DATE_LEN], s))
 
         if matched_lines:
             if len(matched_lines) > max_lines:
@@ -1597,7 +4151,9 @@ def cmd_lastlog(data, buffer, args):
                 return WEECHAT_RC_OK
 
             say("%sLastlog for \"%s\":" % (weechat.color('white'), pattern), buffer)
-            for date, line in matched_lines:
+            for line in matched_lines:
+                date, line = format_line(line)
+                date = int(time.mktime(time.strptime(date, DATE_FORMAT)))
                 prnt_date_tags(buffer, date, 'no_highlight,no_log,grep', line)
             say("%sEnd of Lastlog, %s matches." % (weechat.color('white'),
                                                    len(matched_lines)),
@@ -1610,16 +4166,17 @@ def cmd_lastlog(data, buffer, args):
 
 ### Completion ###
 def completion_log_files(data, completion_item, buffer, completion):
-    home_dir = get_home()
-    home_dir_len = len(home_dir)
-    for log in dir_list(home_dir, include_dir=True):
+    catalogue = get_catalogue()
+    home_dir_len = len(catalogue.dir)
+    for log in catalogue.files(include_dir=True):
         log = log[home_dir_len:] # strip home dir
         weechat.hook_completion_list_add(completion, log, 0, weechat.WEECHAT_LIST_POS_END)
     return WEECHAT_RC_OK
 
 def completion_grep_args(data, completion_item, buffer, completion):
     for arg in ('count', 'matchcase', 'hilight', 'exact', 'head', 'tail', 'number',
-            'after-context', 'before-context', 'context', 'invert', 'only-match'):
+            'after-context', 'before-context', 'context', 'invert', 'only-match', 'reindex',
+            'since', 'until', 'merge', 'nick', 'date', 'text', 'no-cache'):
         weechat.hook_completion_list_add(completion, '--' + arg, 0, weechat.WEECHAT_LIST_POS_SORT)
     for tmpl in templates:
         weechat.hook_completion_list_add(completion, '%{' + tmpl, 0, weechat.WEECHAT_LIST_POS_SORT)
@@ -1689,13 +4246,14 @@ if __name__ == '__main__' and import_ok and \
 
 
     weechat.hook_command(SCRIPT_COMMAND, cmd_grep.__doc__,
-            "log <pattern> [<options>] <expression> || buffer <pattern> [<options>] <expression> || stop",
+            "log <pattern> [<options>] <expression> || buffer <pattern> [<options>] <expression> || stop || more",
 # help
 """
 Grep by default will search in current buffer's log, you can use
    log: Search in log files. The search will be done in the logs that matches <pattern>. Use '*' and '?' as wildcards.
 buffer: Search in buffers. The search will be done in the buffers that matches <pattern>. Use '*' and '?' as wildcards.
   stop: Stops a currently running search.
+  more: Shows the next lines of the last search that didn't fit in grep buffer, see spill_to_disk option.
 
 Grep options:
      -c --count: Just count the number of matched lines instead of showing them.
@@ -1709,6 +4267,20 @@ Grep options:
 -A --after-context <n>: Shows <n> lines of trailing context after matching lines.
 -B --before-context <n>: Shows <n> lines of leading context before matching lines.
 -C --context <n>: Same as using both --after-context and --before-context simultaneously.
+     --reindex: Build the index of the logs to search instead of searching, see index_logs option.
+       --merge: When searching in several buffers, show the matches of all in one list sorted by date.
+--since <date>: Only search lines dated at or after <date>.
+--until <date>: Only search lines dated before <date>.
+                Dates are YYYY-MM-DD[THH:MM[:SS]], HH:MM[:SS] (today), 'today', 'yesterday' or time
+                ago like 30m, 2h, 3d or 1w. A day without time is included whole by --until.
+ --nick <nick>: Only search lines said by <nick>, its mode doesn't matter. Use '*' and '?' as
+                wildcards. With the index the log's lines of other nicks aren't read.
+ --date <date>: Only search lines whose date starts with <date>, like 2012-03 or *-12-25. Use '*'
+                and '?' as wildcards.
+        --text: Search <expression> only in the message, not in the date and nick.
+                With --nick or --date <expression> is optional.
+    --no-cache: Search the logs again, even the ones that didn't change since the same search was
+                done, see cache_size option.
   <expression>: Expression to search.
 
 Grep buffer:
@@ -1728,21 +4300,37 @@ Grep Templates:
 
 Examples:
   Search for urls with the word 'weechat' said by 'nick'
-    /grep nick\\t.*%{url weechat}
+    /grep --nick nick %{url weechat}
   Search for '*.*' string
     /grep %{escape *.*}
+  Search what 'nick' said yesterday
+    /grep --since yesterday --until yesterday --nick nick
+  Search 'nick' in messages, not in lines said by 'nick'
+    /grep --text nick
 """,
             # completion template
             "buffer %(buffers_plugins_names) %(grep_arguments)|%*"
             "||log %(grep_log_files) %(grep_arguments)|%*"
             "||stop"
+            "||more"
             "||%(grep_arguments)|%*",
             'cmd_grep' ,'')
     weechat.hook_command('logs', cmd_logs.__doc__, "[-s|--size] [<pattern>]",
             "-s --size: Sort logs by size.\n"
             " <pattern>: Only show logs that match <pattern>. Use '*' and '?' as wildcards.",
             '--size', 'cmd_logs', '')
-    weechat.hook_command('lastlog', "", "", "", "", 'cmd_lastlog', '')
+    weechat.hook_command('lastlog', cmd_lastlog.__doc__, "[-H|--hilight] [-m|--matchcase] <pattern>",
+            "-H --hilight: Colour exact matches.\n"
+            "-m --matchcase: Don't do case insensitive search.\n"
+            "    <pattern>: Expression to search.",
+            '--hilight|--matchcase', 'cmd_lastlog', '')
+
+    weechat.hook_print('', '', '', 1, 'buffer_print_cb', '')
+    weechat.hook_signal('buffer_cleared', 'buffer_cleared_cb', '')
+    weechat.hook_signal('buffer_closing', 'buffer_cleared_cb', '')
+    # coloured nicks are cached, they change with these
+    for option in ('weechat.color.*', 'weechat.look.nick_color*', 'irc.look.nick_*'):
+        weechat.hook_config(option, 'nick_colors_cb', '')
 
     weechat.hook_completion('grep_log_files', "list of log files",
             'completion_log_files', '')
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+###
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+###
+# Benchmark for grep.py, runs outside WeeChat.
+#
+#   Generates a synthetic WeeChat log and runs /grep over it with a few representative option
+#   combinations, reporting lines/sec, peak RSS and the time spent in each phase (parsing
+#   the options and compiling the regexp, searching the log, printing the results). Each
+#   combination runs in a forked process, so peak RSS is measured per combination.
+#
+#   Usage:
+#       python2 tools/grep_bench.py [--size MiB] [--nicks N] [--words N] [--zipf S]
+#                                   [--pattern P] [--only NAMES] [--repeat N] [--log FILE]
+#                                   [--compress gz|bz2] [--no-mmap] [--keep]
+#
+#   Run it before and after touching the search code, on the same --seed, and compare.
+#
+#   History:
+#   2026-10-17
+#   version 0.1: initial release
+#
+###
+
+import os
+import sys
+import time
+import types
+import random
+import bisect
+import marshal
+import resource
+import tempfile
+import shutil
+from optparse import OptionParser
+
+### Stub weechat module ###
+# only what grep.py uses while searching and printing, output goes nowhere but is counted.
+stub_config = {}
+stub_output = [0, 0] # lines, bytes
+
+def make_weechat_stub(home):
+    weechat = types.ModuleType('weechat')
+    weechat.WEECHAT_RC_OK = 0
+    weechat.WEECHAT_RC_ERROR = -1
+    weechat.WEECHAT_LIST_POS_END = 'end'
+    weechat.WEECHAT_LIST_POS_SORT = 'sort'
+    weechat.WEECHAT_HOOK_PROCESS_RUNNING = -1
+    weechat.WEECHAT_HOOK_PROCESS_ERROR = -2
+
+    def prnt(buffer, s):
+        # several lines can be printed at once
+        stub_output[0] += s.count('\n') + 1
+        stub_output[1] += len(s)
+
+    def prnt_date_tags(buffer, date, tags, s):
+        prnt(buffer, s)
+
+    config_strings = {
+            'logger.file.path': home,
+            'irc.look.nick_prefix': '',
+            'irc.look.nick_suffix': '',
+            }
+
+    stubs = {
+            'register': lambda *args: True,
+            'prnt': prnt,
+            'prnt_date_tags': prnt_date_tags,
+            'color': lambda s: '\x19%s' % s[:2],
+            'prefix': lambda s: '',
+            'config_get': lambda s: s,
+            'config_string': lambda s: config_strings.get(s, ''),
+            'config_integer': lambda s: 16,
+            'config_get_plugin': lambda s: stub_config.get(s, ''),
+            'config_set_plugin': stub_config.__setitem__,
+            'config_is_set_plugin': stub_config.__contains__,
+            'info_get': lambda name, args: name == 'weechat_dir' and home or '',
+            'buffer_search': lambda plugin, name: 'grep_buffer',
+            'buffer_new': lambda *args: 'grep_buffer',
+            'buffer_set': lambda *args: None,
+            'buffer_get_string': lambda buffer, s: buffer,
+            'buffer_clear': lambda buffer: None,
+            'string_remove_color': lambda s, r: s,
+            'hook_timer': lambda *args: 'timer',
+            'hook_process': lambda *args: 'process',
+            'unhook': lambda hook: None,
+            'infolist_get': lambda *args: '',
+            'infolist_next': lambda infolist: 0,
+            'infolist_free': lambda infolist: None,
+            'command': lambda *args: None,
+            }
+    for name, f in stubs.iteritems():
+        setattr(weechat, name, f)
+    return weechat
+
+def import_grep(home):
+    """Imports grep.py from the repository with the stub weechat module, and sets up the globals
+    that the script sets when loaded in WeeChat."""
+    sys.modules['weechat'] = weechat = make_weechat_stub(home)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import grep
+    for opt, val in grep.settings.iteritems():
+        stub_config[opt] = val
+    # always search in WeeChat's process, there's no WeeChat for run a hooked process.
+    stub_config['size_limit'] = ''
+    for name, color in (('date', 'brown'), ('info', 'cyan'), ('hilight', 'lightred'),
+                        ('reset', 'reset'), ('title', 'yellow'), ('summary', 'lightcyan'),
+                        ('delimiter', 'chat_delimiters'), ('script_nick', 'chat_nick')):
+        setattr(grep, 'color_%s' % name, weechat.color(color))
+    grep.script_nick = '[%s]' % grep.SCRIPT_NAME
+    grep.context_sep = '%s\t--' % grep.script_nick
+    grep.debug = lambda s, *args: None
+    return grep
+
+### Synthetic logs ###
+syllables = ('ka', 'ri', 'to', 'me', 'lo', 'sa', 'nu', 'pe', 'di', 'gor', 'an', 'el', 'ux',
+             'bra', 'qui', 'zen', 'fo', 'ty', 'wi', 'hal')
+
+def make_words(n, rnd, min_syllables=1, max_syllables=4):
+    """Returns 'n' different made up words."""
+    words = set()
+    while len(words) < n:
+        words.add(''.join([ rnd.choice(syllables) for i in
+                            range(rnd.randint(min_syllables, max_syllables)) ]))
+    words = list(words)
+    words.sort()
+    rnd.shuffle(words)
+    return words
+
+class zipfChoice(object):
+    """Picks items with a zipf distribution, the first item is the most common."""
+    def __init__(self, items, s, rnd):
+        self.items = items
+        self.random = rnd.random
+        total = 0
+        self.cumulative = L = []
+        for rank in range(1, len(items) + 1):
+            total += 1.0 / rank**s
+            L.append(total)
+        self.total = total
+
+    def __call__(self):
+        return self.items[bisect.bisect(self.cumulative, self.random() * self.total)]
+
+def generate_log(path, size, nicks, words, zipf, seed):
+    """Writes a WeeChat log of about 'size' bytes in 'path', with 'nicks' nicks talking with a
+    vocabulary of 'words' words. Returns the number of lines and the vocabulary, most common
+    words first."""
+    rnd = random.Random(seed)
+    vocabulary = make_words(words, rnd)
+    nick_list = [ rnd.choice(('', '', '', '@', '+')) + nick.capitalize()
+                  for nick in make_words(nicks, rnd, 2, 3) ]
+    word = zipfChoice(vocabulary, zipf, rnd)
+    nick = zipfChoice(nick_list, 1.0, rnd)
+    t = time.mktime((2012, 1, 1, 0, 0, 0, 0, 1, -1))
+    fd = open(path, 'w')
+    written = lines = 0
+    L = []
+    while written < size:
+        t += rnd.expovariate(1 / 20.0)
+        date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+        event = rnd.random()
+        if event < 0.05:
+            name = nick().lstrip('@+')
+            line = '%s\t-->\t%s (~%s@%s.example.org) has joined #bench\n' \
+                    % (date, name, name.lower(), word())
+        elif event < 0.1:
+            name = nick().lstrip('@+')
+            line = '%s\t<--\t%s (~%s@%s.example.org) has quit (%s)\n' \
+                    % (date, name, name.lower(), word(), word())
+        else:
+            text = ' '.join([ word() for i in range(rnd.randint(1, 16)) ])
+            if event < 0.12:
+                text = '%s: http://%s.example.org/%s' % (nick().lstrip('@+'), word(), text)
+            line = '%s\t%s\t%s\n' % (date, nick(), text)
+        L.append(line)
+        written += len(line)
+        lines += 1
+        if len(L) == 1000:
+            fd.write(''.join(L))
+            del L[:]
+    fd.write(''.join(L))
+    fd.close()
+    return lines, vocabulary
+
+def compress_log(path, method):
+    if method == 'gz':
+        import gzip
+        out = gzip.open(path + '.gz', 'wb')
+    else:
+        import bz2
+        out = bz2.BZ2File(path + '.bz2', 'w')
+    fd = open(path)
+    shutil.copyfileobj(fd, out, 1024*1024)
+    fd.close()
+    out.close()
+    return '%s.%s' % (path, method)
+
+### Benchmark ###
+# name, /grep options
+combinations = (
+        ('plain',   ''),
+        ('-H',      '-H'),
+        ('-o',      '-o'),
+        ('-v',      '-v'),
+        ('-m',      '-m'),
+        ('-A 3',    '-A 3'),
+        ('-B 3',    '-B 3'),
+        ('-C 3',    '-C 3'),
+        ('-H -C 2', '-H -C 2'),
+        ('--head',  '--head -n 50'),
+        ('--tail',  '--tail -n 50'),
+        ('-c',      '-c'),
+        )
+
+def peak_rss():
+    """Peak RSS of this process, in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_combination(grep, log, args, pattern):
+    """Runs /grep <args> <pattern> over 'log' and returns a dict with the results."""
+    now = time.time
+    rss_start = peak_rss()
+    result = {}
+
+    # options and regexp
+    t = now()
+    grep.options.reset()
+    grep.cmd_grep_parsing('%s %s' % (args, pattern))
+    options = grep.options
+    regexp = grep.make_regexp(options.pattern, options.matchcase)
+    grep.make_check(regexp, options.hilight, options.exact, options.invert)
+    result['setup'] = now() - t
+
+    # search
+    t = now()
+    log_name = grep.strip_home(log)
+    lines = grep.make_lines(log_name)
+    grep.grep_file(log, options.head, options.tail, options.after_context,
+                   options.before_context, options.count, regexp, options.hilight,
+                   options.exact, options.invert, lines=lines,
+                   fast=grep.get_config_boolean('use_mmap'))
+    result['search'] = now() - t
+    result['matches'] = lines.matches_count
+
+    # print
+    t = now()
+    stub_output[:] = [0, 0]
+    grep.matched_lines = grep.linesDict()
+    grep.matched_lines[log_name] = lines
+    grep.time_start = now()
+    grep.buffer_update()
+    # lines past the first screen are printed from a timer, print them now
+    grep.stop_render(finish=True)
+    result['print'] = now() - t
+    result['printed'] = stub_output[0]
+
+    result['rss'] = peak_rss()
+    result['rss_delta'] = result['rss'] - rss_start
+    return result
+
+def run_forked(f, *args):
+    """Runs 'f' in a child process, so its memory usage doesn't pile up with the others."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+        code = 0
+        try:
+            data = marshal.dumps(f(*args))
+        except:
+            import traceback
+            data = marshal.dumps({'error': traceback.format_exc()})
+            code = 1
+        while data:
+            data = data[os.write(w, data):]
+        os._exit(code)
+    os.close(w)
+    L = []
+    while True:
+        s = os.read(r, 65536)
+        if not s:
+            break
+        L.append(s)
+    os.close(r)
+    os.waitpid(pid, 0)
+    return marshal.loads(''.join(L))
+
+def best_of(results):
+    """Keeps the fastest run of each phase, and the highest RSS."""
+    best = dict(results[0])
+    for result in results[1:]:
+        for key in ('setup', 'search', 'print'):
+            best[key] = min(best[key], result[key])
+        for key in ('rss', 'rss_delta'):
+            best[key] = max(best[key], result[key])
+    return best
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--size', type='float', default=20,
+                      help='size of the generated log in MiB (default: %default)')
+    parser.add_option('--nicks', type='int', default=200,
+                      help='number of nicks in the log (default: %default)')
+    parser.add_option('--words', type='int', default=5000,
+                      help='vocabulary size (default: %default)')
+    parser.add_option('--zipf', type='float', default=1.1,
+                      help='exponent of the word distribution (default: %default)')
+    parser.add_option('--seed', type='int', default=1,
+                      help='random seed for the generated log (default: %default)')
+    parser.add_option('--pattern', default='',
+                      help='pattern to search, by default a word matching about 0.5% of lines')
+    parser.add_option('--only', default='',
+                      help='comma separated names of the combinations to run')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='runs of each combination, the best is shown (default: %default)')
+    parser.add_option('--log', default='',
+                      help='use this log instead of generating one')
+    parser.add_option('--compress', choices=('gz', 'bz2'),
+                      help='search a compressed copy of the log')
+    parser.add_option('--no-mmap', action='store_true', help="set use_mmap to 'off'")
+    parser.add_option('--max-lines', default='',
+                      help="max_lines setting (default: the script's default)")
+    parser.add_option('--keep', action='store_true', help="don't remove the generated log")
+    opts, args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='grep_bench.')
+    try:
+        t = time.time()
+        if opts.log:
+            log = os.path.abspath(opts.log)
+            total_lines = sum([ 1 for line in open(log) ])
+            pattern = opts.pattern
+            if not pattern:
+                parser.error('--pattern is needed with --log')
+        else:
+            log = os.path.join(home, 'irc.bench.#bench.weechatlog')
+            total_lines, vocabulary = generate_log(log, int(opts.size * 1024 * 1024),
+                                                   opts.nicks, opts.words, opts.zipf,
+                                                   opts.seed)
+            pattern = opts.pattern or pick_pattern(vocabulary, opts.zipf)
+        if opts.compress:
+            log = compress_log(log, opts.compress)
+        size = os.path.getsize(log)
+        print 'log: %s (%.1f MiB, %s lines, %.2f seconds)' % (log, size / 1048576.0,
+                                                                total_lines, time.time() - t)
+        print 'pattern: %s' % pattern
+
+        grep = import_grep(home)
+        if opts.no_mmap:
+            stub_config['use_mmap'] = 'off'
+        if opts.max_lines:
+            stub_config['max_lines'] = opts.max_lines
+        # warm up the page cache, so the first combination doesn't pay for it.
+        fd = open(log)
+        while fd.read(1024*1024):
+            pass
+        fd.close()
+
+        names = opts.only and opts.only.split(',') or None
+        header = '%-9s %8s %8s %8s %8s %8s %10s %8s %8s %9s' % (
+                'options', 'matches', 'printed', 'setup', 'search', 'print', 'lines/s',
+                'MiB/s', 'RSS MiB', 'RSS +MiB')
+        print header
+        print '-' * len(header)
+        for name, args in combinations:
+            if names and name not in names:
+                continue
+            results = [ run_forked(run_combination, grep, log, args, pattern)
+                        for i in range(max(opts.repeat, 1)) ]
+            for result in results:
+                if 'error' in result:
+                    print '%-9s failed:\n%s' % (name, result['error'])
+                    break
+            else:
+                r = best_of(results)
+                search = max(r['search'], 1e-6)
+                print '%-9s %8s %8s %8.3f %8.3f %8.3f %10d %8.1f %8.1f %9.1f' % (
+                        name, r['matches'], r['printed'], r['setup'], r['search'], r['print'],
+                        total_lines / search, size / 1048576.0 / search, r['rss'] / 1024.0,
+                        r['rss_delta'] / 1024.0)
+                sys.stdout.flush()
+    finally:
+        if opts.keep:
+            print 'kept %s' % home
+        else:
+            shutil.rmtree(home, True)
+
+def pick_pattern(vocabulary, s, frequency=0.005):
+    """Returns the most common word of the vocabulary that should be in about 'frequency' of the
+    lines, lines have 8 words on average. Made up words are often part of others, so it will
+    match a bit more."""
+    total = sum([ 1.0 / rank**s for rank in range(1, len(vocabulary) + 1) ])
+    for rank, word in enumerate(vocabulary):
+        if 1.0 / (rank + 1)**s / total < frequency / 8:
+            return word
+    return vocabulary[-1]
+
+if __name__ == '__main__':
+    main()